@@ -14,6 +14,9 @@ setup(
         'django>=1.4',
         'PIL>=1.1.7',
     ],
+    extras_require={
+        'brotli': ['brotli>=0.6'],
+    },
     tests_require=[
         'unittest2>=0.5.1',
         'mock>=0.8.0',
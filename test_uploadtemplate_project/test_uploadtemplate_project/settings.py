@@ -144,3 +144,6 @@ LOGGING = {
         },
     }
 }
+
+# Remove the files of old theme revisions straight away in tests.
+UPLOADTEMPLATE_PRUNE_DELAY = 0
@@ -23,6 +23,20 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_uploadtemplate_project.set
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Fill uploadtemplate's caches before the first request, rather than during
+# it. With a server which preloads the application before forking, this
+# only needs doing once; warm_up() closes its database connections, so the
+# forked workers don't share them. It's only an optimisation, so a failure
+# (say, before the database has been migrated) mustn't stop the application
+# from starting.
+import logging
+from uploadtemplate.warmup import warm_up
+try:
+    warm_up(compile_templates=True)
+except Exception:
+    logging.getLogger('uploadtemplate.warmup').exception(
+                                        "Warming up theme caches failed.")
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)
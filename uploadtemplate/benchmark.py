@@ -0,0 +1,343 @@
+"""
+Benchmarks for the hot paths of theme handling: template lookup, static
+URL resolution, extraction and pruning.
+
+Everything runs against a :class:`LatencyStorage`, an in-memory storage
+which sleeps on every call and counts them, so the results show how many
+round-trips a remote storage would make as well as how long things take.
+Run them with ``manage.py benchmark_themes``.
+
+"""
+import errno
+import json
+import threading
+import time
+import zipfile
+from collections import namedtuple
+from contextlib import contextmanager
+from StringIO import StringIO
+from timeit import default_timer
+
+from django.contrib.sites.models import Site
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, Storage
+from django.template import Context, TemplateDoesNotExist
+from django.test.utils import override_settings
+
+from uploadtemplate import cache
+from uploadtemplate.loader import Loader
+from uploadtemplate.models import Theme
+from uploadtemplate.templatetags.uploadtemplate import static
+
+
+#: The theme sizes, in files, benchmarked by default.
+DEFAULT_SIZES = (10, 100, 1000, 10000)
+
+
+class LatencyStorage(Storage):
+    """
+    An in-memory storage which sleeps for ``latency`` seconds on every call
+    that would be a round-trip to a remote storage, and counts those calls
+    by method in :attr:`calls`. Like most remote storages, it has no local
+    paths, so directories are listed one :meth:`listdir` at a time.
+
+    """
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.files = {}
+        self.calls = {}
+        # Number of files under each directory, so that exists() is cheap.
+        self._directories = {}
+        self._lock = threading.Lock()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    def call_count(self):
+        return sum(self.calls.itervalues())
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _open(self, name, mode='rb'):
+        self._call('open')
+        try:
+            content = self.files[name]
+        except KeyError:
+            raise IOError(errno.ENOENT, "No such file", name)
+        return ContentFile(content, name=name)
+
+    def _save(self, name, content):
+        self._call('save')
+        self._add(name, ''.join(content.chunks()))
+        return name
+
+    def delete(self, name):
+        self._call('delete')
+        self._remove(name)
+
+    def exists(self, name):
+        self._call('exists')
+        return (name in self.files or
+                self._directories.get(name.rstrip('/'), 0) > 0)
+
+    def listdir(self, path):
+        self._call('listdir')
+        prefix = path.rstrip('/') + '/' if path else ''
+        directories, filenames = set(), []
+        for name in self.files:
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if '/' in rest:
+                directories.add(rest.split('/', 1)[0])
+            else:
+                filenames.append(rest)
+        return list(directories), filenames
+
+    def size(self, name):
+        self._call('size')
+        return len(self.files[name])
+
+    def url(self, name):
+        return 'https://storage.invalid/' + name
+
+    def _add(self, name, content):
+        with self._lock:
+            if name not in self.files:
+                for directory in self._parents(name):
+                    self._directories[directory] = (
+                                    self._directories.get(directory, 0) + 1)
+            self.files[name] = content
+
+    def _remove(self, name):
+        with self._lock:
+            if self.files.pop(name, None) is not None:
+                for directory in self._parents(name):
+                    self._directories[directory] -= 1
+
+    def _parents(self, name):
+        parts = name.split('/')[:-1]
+        return ['/'.join(parts[:i]) for i in xrange(1, len(parts) + 1)]
+
+
+class FlatLatencyStorage(LatencyStorage):
+    """
+    A :class:`LatencyStorage` which, like an object store, can list
+    everything under a prefix and delete many files in single calls.
+
+    """
+    def list_prefix(self, prefix):
+        self._call('list_prefix')
+        return [name for name in self.files if name.startswith(prefix)]
+
+    def delete_many(self, names):
+        self._call('delete_many')
+        for name in names:
+            self._remove(name)
+
+
+class Result(namedtuple('Result', 'size name ops seconds calls')):
+    """
+    The outcome of one benchmark: ``ops`` operations on a theme of ``size``
+    files took ``seconds`` and made ``calls`` storage calls.
+
+    """
+    @property
+    def mean(self):
+        return self.seconds / self.ops
+
+    @property
+    def ops_per_second(self):
+        return self.ops / self.seconds if self.seconds else float('inf')
+
+    @property
+    def calls_per_op(self):
+        return float(self.calls) / self.ops
+
+    def format(self):
+        return ('{0.size:>6} {0.name:<26} {0.ops:>6} ops '
+                '{1:>12.1f} us/op {0.ops_per_second:>11.1f} ops/s '
+                '{0.calls_per_op:>9.2f} calls/op'.format(self,
+                                                         self.mean * 1e6))
+
+
+def build_theme_zip(file_count):
+    """
+    Returns the contents of a synthetic theme zip file with ``file_count``
+    files (at least two), as a ``(content, template names, static paths)``
+    tuple. About a tenth of the files are templates; the rest are CSS
+    (which refers to an image), JavaScript and images, spread over
+    directories of 100 files. The contents depend only on ``file_count``.
+
+    """
+    templates, static_paths = [], []
+    fp = StringIO()
+    zip_file = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED)
+    zip_file.writestr('templates/bench/index.html', 'Index\n')
+    templates.append('bench/index.html')
+    zip_file.writestr('static/img/logo.png', 'PNG' * 100)
+    static_paths.append('img/logo.png')
+    for i in xrange(2, file_count):
+        directory = 'dir{0}'.format(i // 100)
+        kind = i % 10
+        if kind == 0:
+            name = 'bench/{0}/page{1}.html'.format(directory, i)
+            templates.append(name)
+            zip_file.writestr('templates/' + name,
+                              '{{% block content %}}Page {0}'
+                              '{{% endblock %}}\n'.format(i))
+            continue
+        if kind <= 3:
+            path = 'css/{0}/style{1}.css'.format(directory, i)
+            content = ('.item{0} {{ background: '
+                       'url(../../img/logo.png); }}\n'.format(i)) * 20
+        elif kind <= 6:
+            path = 'js/{0}/script{1}.js'.format(directory, i)
+            content = 'var value{0} = {0};\n'.format(i) * 50
+        else:
+            path = 'img/{0}/image{1}.png'.format(directory, i)
+            content = ''.join(chr((i * j) % 256) for j in xrange(512))
+        static_paths.append(path)
+        zip_file.writestr('static/' + path, content)
+    zip_file.close()
+    return fp.getvalue(), templates, static_paths
+
+
+@contextmanager
+def using_storage(storage):
+    """
+    Replaces the default storage with ``storage`` for the duration of the
+    block.
+
+    """
+    old = default_storage._wrapped
+    default_storage._wrapped = storage
+    try:
+        yield storage
+    finally:
+        default_storage._wrapped = old
+
+
+@contextmanager
+def benchmark_site():
+    """
+    Creates a temporary site and makes it the current one, so that the
+    benchmark themes can be made default without affecting real sites.
+    The site and its themes are deleted afterwards.
+
+    """
+    site = Site.objects.create(domain='uploadtemplate-benchmark.invalid',
+                               name='uploadtemplate benchmark')
+    try:
+        with override_settings(SITE_ID=site.pk):
+            yield site
+    finally:
+        site.delete()
+        Theme.objects.clear_cache()
+        cache.clear()
+
+
+def measure(name, size, ops, storage, func, warm_up=False):
+    """
+    Calls ``func`` with each number in ``range(ops)`` and returns a
+    :class:`Result` for the calls. With ``warm_up``, the calls are made once
+    beforehand without being measured.
+
+    """
+    if warm_up:
+        for i in xrange(ops):
+            func(i)
+    storage.reset_calls()
+    start = default_timer()
+    for i in xrange(ops):
+        func(i)
+    seconds = default_timer() - start
+    return Result(size, name, ops, seconds, storage.call_count())
+
+
+def benchmark_theme(size, iterations, storage):
+    """
+    Runs every benchmark against a synthetic theme of ``size`` files
+    stored in ``storage``, and returns a list of :class:`Result`. Lookups
+    are repeated ``iterations`` times; extraction and pruning once.
+
+    """
+    content, templates, static_paths = build_theme_zip(size)
+    missing = ['bench/missing{0}.html'.format(i) for i in xrange(100)]
+    results = []
+    loader = Loader()
+
+    def load(name):
+        try:
+            loader.load_template_source(name)
+        except TemplateDoesNotExist:
+            pass
+
+    def change_one_file(i):
+        # Make one file look changed, so that only it is rewritten.
+        manifest = theme.get_manifest()
+        manifest['static/img/logo.png']['crc'] ^= 1 << (i % 16)
+        theme.manifest = json.dumps(manifest)
+        theme.save_files()
+
+    def cold(func):
+        def wrapper(i):
+            cache.clear()
+            func(i)
+        return wrapper
+
+    with using_storage(storage):
+        with benchmark_site() as site:
+            # Extraction timings include pruning the previous revision.
+            with override_settings(UPLOADTEMPLATE_PRUNE_DELAY=0):
+                theme = Theme(name='Benchmark', site=site, default=True)
+                theme.theme_files_zip.save('benchmark.zip',
+                                           ContentFile(content))
+                cache.clear()
+
+                def run(name, ops, func, warm_up=False):
+                    results.append(measure(name, size, ops, storage, func,
+                                           warm_up))
+
+                run('extract', 1, lambda i: theme.save_files())
+                run('extract (unchanged)', 1, lambda i: theme.save_files())
+                run('extract (one file changed)', 1, change_one_file)
+                run('prune', 1, lambda i: theme.prune_files())
+
+                template = lambda i: templates[i % len(templates)]
+                path = lambda i: static_paths[i % len(static_paths)]
+                context = Context()
+                run('template hit (cold)', iterations,
+                    cold(lambda i: load(template(i))))
+                run('template hit (warm)', iterations,
+                    lambda i: load(template(i)), warm_up=True)
+                run('template miss', iterations,
+                    lambda i: load(missing[i % len(missing)]))
+                run('static hit (cold)', iterations,
+                    cold(lambda i: static(context, path(i))))
+                run('static hit (warm)', iterations,
+                    lambda i: static(context, path(i)), warm_up=True)
+                run('static miss', iterations,
+                    lambda i: static(context, 'missing/{0}.png'.format(i)))
+    return results
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, iterations=200, latency=0,
+                   flat=False):
+    """
+    Runs the benchmarks for themes of each of ``sizes`` files, against a
+    fresh :class:`LatencyStorage` (or :class:`FlatLatencyStorage`, if
+    ``flat``) with ``latency`` seconds per call. Yields a :class:`Result`
+    for each benchmark as it finishes.
+
+    """
+    storage_class = FlatLatencyStorage if flat else LatencyStorage
+    for size in sizes:
+        for result in benchmark_theme(size, iterations,
+                                      storage_class(latency)):
+            yield result
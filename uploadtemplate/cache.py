@@ -0,0 +1,305 @@
+"""
+In-process caches for theme contents.
+
+"""
+import os
+import threading
+
+from django.conf import settings
+
+from uploadtemplate.instrumentation import timed
+from uploadtemplate.signals import theme_files_changed
+from uploadtemplate.utils import iter_files, serve_from_zip
+from uploadtemplate.zipreader import open_zip_reader
+
+
+# Indexes into the linked-list nodes used by LRUCache.
+_PREV, _NEXT, _KEY, _VALUE, _SIZE = 0, 1, 2, 3, 4
+
+
+class LRUCache(object):
+    """
+    A thread-safe least-recently-used cache which is bounded by the total
+    size of its values rather than by the number of entries. ``sizeof`` is
+    called on each value to determine how much of ``max_size`` it uses.
+
+    """
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._lock = threading.RLock()
+        self._map = {}
+        # Circular doubly-linked list; root.next is the least-recently used
+        # entry and root.prev the most-recently used.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, 0]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def get(self, key, default=None):
+        with self._lock:
+            node = self._map.get(key)
+            if node is None:
+                return default
+            self._unlink(node)
+            self._append(node)
+            return node[_VALUE]
+
+    def set(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._map:
+                self._remove(self._map[key])
+            if size > self.max_size:
+                return
+            node = [None, None, key, value, size]
+            self._map[key] = node
+            self._append(node)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(self._root[_NEXT])
+
+    def delete(self, key):
+        with self._lock:
+            node = self._map.get(key)
+            if node is not None:
+                self._remove(node)
+
+    def delete_matching(self, predicate):
+        """
+        Removes every entry whose key satisfies ``predicate``.
+
+        """
+        with self._lock:
+            for key in [key for key in self._map if predicate(key)]:
+                self._remove(self._map[key])
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, 0]
+            self.size = 0
+
+    def _append(self, node):
+        last = self._root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = self._root
+        last[_NEXT] = node
+        self._root[_PREV] = node
+
+    def _unlink(self, node):
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self._map[node[_KEY]]
+        self.size -= node[_SIZE]
+
+
+# Rough per-entry bookkeeping cost, so that negative entries still count
+# against the cache size.
+ENTRY_OVERHEAD = 100
+
+
+def _template_source_size(value):
+    if value is None:
+        return ENTRY_OVERHEAD
+    source, name = value
+    return len(source) + len(name) + ENTRY_OVERHEAD
+
+
+#: Maps (theme pk, theme revision, template name) to a (source, name) tuple,
+#: or to ``None`` if the template couldn't be read from the theme's files.
+template_source_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_TEMPLATE_CACHE_SIZE', 2 * 1024 * 1024),
+    sizeof=_template_source_size)
+
+
+#: Maps (theme pk, theme revision, template name) to a compiled template.
+#: Bounded by the number of templates rather than their size.
+compiled_template_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_COMPILED_TEMPLATE_CACHE_SIZE', 500),
+    sizeof=lambda template: 1)
+
+
+#: Maps (theme pk, theme revision) to a frozenset of the names (paths within
+#: the theme's zip file) of the files the theme provides.
+theme_files_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_THEME_FILES_CACHE_SIZE', 50),
+    sizeof=lambda names: 1)
+
+
+def get_theme_files(theme):
+    """
+    Returns a frozenset of the names of the files the theme provides, as
+    paths within its zip file. They come from the theme's manifest or zip
+    file where possible, and otherwise from a single listing of its files
+    in storage, which is made at most once per theme revision.
+
+    """
+    key = (theme.pk, theme.revision)
+    names = theme_files_cache.get(key)
+    if names is None:
+        with timed('theme_files_listing', theme=theme.pk):
+            names = frozenset(_list_theme_files(theme))
+        theme_files_cache.set(key, names)
+    return names
+
+
+def _list_theme_files(theme):
+    if serve_from_zip():
+        if not theme.theme_files_zip:
+            return []
+        return get_zip_reader(theme).namelist()
+    manifest = theme.get_manifest()
+    if manifest is not None:
+        return manifest.keys()
+    # Without a manifest, only the storage knows which files have been
+    # extracted.
+    root = theme.theme_files_dir
+    return [name[len(root):] for name in iter_files(root)]
+
+
+#: Maps (theme pk, theme revision) to a (theme paths, legacy paths) tuple of
+#: frozensets holding the static file paths the theme provides.
+static_manifest_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_STATIC_MANIFEST_CACHE_SIZE', 50),
+    sizeof=lambda manifest: 1)
+
+
+def get_static_manifest(theme):
+    """
+    Returns a tuple of two frozensets: the static paths provided by the
+    theme's files, and those provided by its legacy static directory. Paths
+    are relative to the static directory.
+
+    """
+    key = (theme.pk, theme.revision)
+    manifest = static_manifest_cache.get(key)
+    if manifest is None:
+        prefix = 'static/'
+        manifest = (frozenset(name[len(prefix):]
+                              for name in get_theme_files(theme)
+                              if name.startswith(prefix)),
+                    _list_legacy(theme, _list_legacy_static))
+        static_manifest_cache.set(key, manifest)
+    return manifest
+
+
+#: Maps (theme pk, theme revision) to a (theme names, legacy names) tuple of
+#: frozensets holding the names of the templates the theme provides.
+template_manifest_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_TEMPLATE_MANIFEST_CACHE_SIZE', 50),
+    sizeof=lambda manifest: 1)
+
+
+def get_template_manifest(theme):
+    """
+    Returns a tuple of two frozensets: the names of the templates provided
+    by the theme's files, and of those provided by its legacy template
+    directory. Any other template can be skipped without touching storage
+    or the filesystem.
+
+    """
+    key = (theme.pk, theme.revision)
+    manifest = template_manifest_cache.get(key)
+    if manifest is None:
+        prefix = 'templates/'
+        manifest = (frozenset(name[len(prefix):]
+                              for name in get_theme_files(theme)
+                              if name.startswith(prefix)),
+                    _list_legacy(theme, _list_legacy_templates))
+        template_manifest_cache.set(key, manifest)
+    return manifest
+
+
+def _list_legacy(theme, lister):
+    with timed('legacy_listing', theme=theme.pk):
+        return frozenset(lister(theme))
+
+
+def _list_legacy_static(theme):
+    if not hasattr(settings, 'UPLOADTEMPLATE_MEDIA_ROOT'):
+        return []
+    return _list_local_dir(theme.static_root())
+
+
+def _list_legacy_templates(theme):
+    if not hasattr(settings, 'UPLOADTEMPLATE_MEDIA_ROOT'):
+        return []
+    return _list_local_dir(theme.template_dir())
+
+
+def _list_local_dir(root):
+    paths = []
+    for dir_path, dirs, files in os.walk(root):
+        for filename in files:
+            path = os.path.relpath(os.path.join(dir_path, filename), root)
+            paths.append(path.replace(os.sep, '/'))
+    return paths
+
+
+#: Maps (theme pk, theme revision) to an open ZipReader for the theme's zip
+#: file. Readers are closed when they are garbage-collected, rather than on
+#: eviction, since another thread may still be reading from them.
+zip_reader_cache = LRUCache(
+    getattr(settings, 'UPLOADTEMPLATE_ZIP_READER_CACHE_SIZE', 10),
+    sizeof=lambda reader: 1)
+_zip_reader_lock = threading.Lock()
+
+
+def get_zip_reader(theme):
+    """
+    Returns a :class:`~uploadtemplate.zipreader.ZipReader` for the theme's
+    zip file, shared by every thread in this process.
+
+    """
+    key = (theme.pk, theme.revision)
+    reader = zip_reader_cache.get(key)
+    if reader is None:
+        # Only open each zip file once, even if several threads ask for it.
+        with _zip_reader_lock:
+            reader = zip_reader_cache.get(key)
+            if reader is None:
+                with timed('zip_open', theme=theme.pk):
+                    reader = open_zip_reader(theme.theme_files_zip)
+                zip_reader_cache.set(key, reader)
+    return reader
+
+
+def invalidate_theme(theme_pk):
+    """
+    Drops every cached entry belonging to the theme with the given pk.
+
+    """
+    predicate = lambda key: key[0] == theme_pk
+    template_source_cache.delete_matching(predicate)
+    compiled_template_cache.delete_matching(predicate)
+    theme_files_cache.delete_matching(predicate)
+    template_manifest_cache.delete_matching(predicate)
+    static_manifest_cache.delete_matching(predicate)
+    zip_reader_cache.delete_matching(predicate)
+
+
+def clear():
+    """
+    Empties all of the theme content caches.
+
+    """
+    template_source_cache.clear()
+    compiled_template_cache.clear()
+    theme_files_cache.clear()
+    template_manifest_cache.clear()
+    static_manifest_cache.clear()
+    zip_reader_cache.clear()
+
+
+def _theme_files_changed(sender, instance, **kwargs):
+    invalidate_theme(instance.pk)
+theme_files_changed.connect(_theme_files_changed)
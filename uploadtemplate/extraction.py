@@ -0,0 +1,524 @@
+"""
+Helpers for writing the contents of a theme's zip file to storage.
+
+"""
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import default_storage
+
+
+# Zip entries are copied to storage in chunks of this size.
+CHUNK_SIZE = 64 * 1024
+
+# Entries are spooled through a temporary file which stays in memory up to
+# this size and is moved to disk beyond it.
+SPOOL_SIZE = 1024 * 1024
+
+# Number of hex digits of a file's MD5 hash used in its hashed name.
+HASH_LENGTH = 12
+
+# References to other files from CSS: url(...) and @import "...". Each
+# pattern captures the text before the reference, the reference itself,
+# and the text after it.
+CSS_URL_PATTERNS = (
+    re.compile(r"""(url\(\s*['"]?\s*)([^'")\s]+)(\s*['"]?\s*\))""",
+               re.IGNORECASE),
+    re.compile(r"""(@import\s*['"]\s*)([^'"\s]+)(\s*['"])""",
+               re.IGNORECASE),
+)
+
+# Content types, besides text/*, which are worth precompressing.
+COMPRESSIBLE_TYPES = frozenset([
+    'application/javascript',
+    'application/json',
+    'application/x-javascript',
+    'application/xml',
+    'image/svg+xml',
+    'image/x-icon',
+    'image/vnd.microsoft.icon',
+])
+
+# File extensions of precompressed copies, by content coding.
+ENCODING_EXTENSIONS = {'gzip': 'gz', 'br': 'br'}
+
+
+class ThemeExtractionError(Exception):
+    """
+    Raised when one or more files couldn't be extracted from a theme's zip
+    file. ``errors`` is a list of ``(filename, exception)`` tuples.
+
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        super(ThemeExtractionError, self).__init__(
+            "Could not extract {count} file(s): {details}".format(
+                count=len(errors),
+                details='; '.join('{0}: {1!r}'.format(filename, exc)
+                                  for filename, exc in errors)))
+
+
+class ThemeSizeError(ValueError):
+    """
+    Raised when a zip entry, or a theme's zip file as a whole, uncompresses
+    to more than the configured maximum size.
+
+    """
+
+
+def get_max_file_size():
+    return getattr(settings, 'UPLOADTEMPLATE_MAX_FILE_SIZE', 50 * 1024 * 1024)
+
+
+def get_max_total_size():
+    return getattr(settings, 'UPLOADTEMPLATE_MAX_TOTAL_SIZE',
+                   250 * 1024 * 1024)
+
+
+def extract_files(zip_file, filenames, target_dir, workers=None,
+                  targets=None):
+    """
+    Writes each of ``filenames`` from ``zip_file`` to ``target_dir`` in the
+    default storage, replacing any existing files. ``targets`` may map some
+    of the filenames to other names (relative to ``target_dir``) to write
+    them to instead.
+
+    Entries are streamed out of the zip file in chunks rather than read
+    into memory, and may not uncompress to more than
+    ``UPLOADTEMPLATE_MAX_FILE_SIZE`` bytes each or
+    ``UPLOADTEMPLATE_MAX_TOTAL_SIZE`` bytes in all. A :exc:`ThemeSizeError`
+    is raised straight away if the sizes recorded in the zip file exceed
+    the total limit.
+
+    If ``workers`` (which defaults to ``UPLOADTEMPLATE_EXTRACT_WORKERS``) is
+    greater than one, files are written from a pool of that many threads.
+    Either way, every file is attempted; failures are collected and raised
+    together as a :exc:`ThemeExtractionError`.
+
+    """
+    if workers is None:
+        workers = getattr(settings, 'UPLOADTEMPLATE_EXTRACT_WORKERS', 1)
+    max_file_size = get_max_file_size()
+    max_total_size = get_max_total_size()
+
+    if max_total_size is not None:
+        declared = sum(info.file_size for info in zip_file.infolist())
+        if declared > max_total_size:
+            raise ThemeSizeError("Theme uncompresses to {0} bytes; the "
+                                 "maximum is {1}.".format(declared,
+                                                          max_total_size))
+
+    # ZipFile isn't safe to read from several threads at once.
+    lock = threading.Lock()
+    # Running total of bytes read; a list so that extract can update it.
+    total = [0]
+
+    def spool(filename):
+        info = zip_file.getinfo(filename)
+        if max_file_size is not None and info.file_size > max_file_size:
+            raise ThemeSizeError("{0} is larger than {1} bytes.".format(
+                                                filename, max_file_size))
+        fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            with lock:
+                entry = zip_file.open(info)
+                try:
+                    size = _copy(entry, fp, filename, max_file_size, total,
+                                 max_total_size)
+                finally:
+                    entry.close()
+        except:
+            fp.close()
+            raise
+        fp.seek(0)
+        content = File(fp, name=filename)
+        content.size = size
+        return content
+
+    def extract(filename):
+        try:
+            content = spool(filename)
+            try:
+                name = os.path.join(target_dir,
+                                    (targets or {}).get(filename, filename))
+                if default_storage.exists(name):
+                    default_storage.delete(name)
+                default_storage.save(name, content)
+            finally:
+                content.close()
+        except Exception, e:
+            return (filename, e)
+
+    filenames = list(filenames)
+    if workers > 1 and len(filenames) > 1:
+        pool = ThreadPool(min(workers, len(filenames)))
+        try:
+            results = pool.map(extract, filenames)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract(filename) for filename in filenames]
+
+    errors = [result for result in results if result is not None]
+    if errors:
+        raise ThemeExtractionError(errors)
+
+
+def _copy(source, dest, filename, max_file_size, total, max_total_size):
+    """
+    Copies ``source`` to ``dest`` in chunks, enforcing the size limits
+    against the bytes actually read, since the sizes recorded in a zip file
+    can't be trusted. Returns the number of bytes copied.
+
+    """
+    size = 0
+    while True:
+        chunk = source.read(CHUNK_SIZE)
+        if not chunk:
+            return size
+        size += len(chunk)
+        total[0] += len(chunk)
+        if max_file_size is not None and size > max_file_size:
+            raise ThemeSizeError("{0} is larger than {1} bytes.".format(
+                                                filename, max_file_size))
+        if max_total_size is not None and total[0] > max_total_size:
+            raise ThemeSizeError("Theme uncompresses to more than {0} "
+                                 "bytes.".format(max_total_size))
+        dest.write(chunk)
+
+
+def _read(zip_file, name):
+    """
+    Returns the contents of ``name`` in ``zip_file``, read in chunks and
+    subject to ``UPLOADTEMPLATE_MAX_FILE_SIZE``.
+
+    """
+    fp = StringIO()
+    entry = zip_file.open(name)
+    try:
+        _copy(entry, fp, name, get_max_file_size(), [0], None)
+    finally:
+        entry.close()
+    return fp.getvalue()
+
+
+def hashed_name(name, digest):
+    """
+    Returns ``name`` with the start of a hex ``digest`` inserted before its
+    extension, e.g. ``static/css/site.0123456789ab.css``.
+
+    """
+    root, ext = posixpath.splitext(name)
+    return '{0}.{1}{2}'.format(root, digest[:HASH_LENGTH], ext)
+
+
+def write_hashed_files(zip_file, manifest, old_manifest, changed, root_dir,
+                       revision):
+    """
+    Gives every static file in ``manifest`` a copy whose name includes a
+    hash of its contents, so that it can be cached indefinitely, and
+    records that copy's ``hashed_path`` (relative to ``root_dir``) in the
+    file's manifest entry. References to other static files from within CSS
+    files are rewritten to point at their hashed copies, so a CSS file's
+    hash changes whenever one of the files it uses does.
+
+    Unchanged files keep the hashed copies from ``old_manifest``; new ones
+    are written to the directory of ``revision``. Errors are raised
+    together as a :exc:`ThemeExtractionError`.
+
+    """
+    revision_dir = '{0}{1}/'.format(root_dir, revision)
+    changed = set(changed)
+    static = [name for name in manifest if name.startswith('static/')]
+
+    def reuse(name, hashed):
+        # Returns the old hashed copy of ``name`` if it is ``hashed``.
+        old_path = (old_manifest.get(name) or {}).get('hashed_path')
+        if old_path is not None and old_path.split('/', 1)[-1] == hashed:
+            return old_path
+        return None
+
+    to_copy = {}
+    for name in static:
+        if _is_css(name):
+            continue
+        old_entry = old_manifest.get(name) or {}
+        if name not in changed and 'hashed_path' in old_entry:
+            manifest[name]['hashed_path'] = old_entry['hashed_path']
+            continue
+        hashed = hashed_name(name, _zip_digest(zip_file, name))
+        path = reuse(name, hashed)
+        if path is None:
+            to_copy[name] = hashed
+            path = '{0}/{1}'.format(revision, hashed)
+        manifest[name]['hashed_path'] = path
+
+    errors = []
+    if to_copy:
+        try:
+            extract_files(zip_file, to_copy, revision_dir, targets=to_copy)
+        except ThemeExtractionError, e:
+            errors.extend(e.errors)
+
+    # CSS files are hashed after rewriting, which needs the hashed names of
+    # the files they refer to; @imported CSS files are hashed on demand.
+    resolved = {}
+
+    def resolve(name):
+        entry = manifest.get(name)
+        if entry is None or not name.startswith('static/'):
+            return None
+        if name not in resolved:
+            # Guards against @import cycles.
+            resolved[name] = None
+            if _is_css(name):
+                resolved[name] = hash_css(name)
+            else:
+                resolved[name] = entry.get('hashed_path')
+        return resolved[name]
+
+    def hash_css(name):
+        try:
+            content = rewrite_css(_read(zip_file, name), name, resolve)
+            hashed = hashed_name(name, hashlib.md5(content).hexdigest())
+            path = reuse(name, hashed)
+            if path is None:
+                target = revision_dir + hashed
+                if default_storage.exists(target):
+                    default_storage.delete(target)
+                default_storage.save(target, ContentFile(content))
+                path = '{0}/{1}'.format(revision, hashed)
+        except Exception, e:
+            errors.append((name, e))
+            return None
+        manifest[name]['hashed_path'] = path
+        return path
+
+    for name in static:
+        if _is_css(name):
+            resolve(name)
+
+    if errors:
+        raise ThemeExtractionError(errors)
+
+
+def rewrite_css(content, css_name, resolve):
+    """
+    Rewrites relative references in ``content``, the contents of the CSS
+    file ``css_name``, to point at hashed copies. ``resolve`` is called with
+    the name a reference points to and returns the path of its hashed copy
+    relative to the theme's root directory, or ``None`` to leave the
+    reference alone. The rewritten references are relative to the root
+    directory too, so they hold from the CSS file's hashed copy in any
+    revision.
+
+    """
+    def replace(match):
+        before, url, after = match.groups()
+        return before + _rewrite_url(url, css_name, resolve) + after
+
+    for pattern in CSS_URL_PATTERNS:
+        content = pattern.sub(replace, content)
+    return content
+
+
+def _rewrite_url(url, css_name, resolve):
+    if (url.startswith(('#', '/', 'data:')) or
+        re.match(r'^[a-z][a-z0-9+.-]*:', url, re.IGNORECASE)):
+        return url
+    match = re.match(r'^([^?#]*)(.*)$', url)
+    path, suffix = match.groups()
+    basename = posixpath.basename(path)
+    if not basename:
+        return url
+    target = posixpath.normpath(posixpath.join(posixpath.dirname(css_name),
+                                               path))
+    hashed_path = resolve(target)
+    if hashed_path is None:
+        return url
+    # The hashed copy may be in another revision's directory. Hashed copies
+    # of CSS files are always a revision directory below the root, so
+    # climbing back up to the root works wherever the CSS file is written.
+    return '../' * (css_name.count('/') + 1) + hashed_path + suffix
+
+
+def _is_css(name):
+    return name.lower().endswith('.css')
+
+
+def _zip_digest(zip_file, name):
+    digest = hashlib.md5()
+    entry = zip_file.open(name)
+    try:
+        while True:
+            chunk = entry.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    finally:
+        entry.close()
+    return digest.hexdigest()
+
+
+def get_precompress_encodings():
+    """
+    Returns the content codings to precompress static files with: always
+    ``'gzip'``, and ``'br'`` if the ``brotli`` module is installed.
+
+    """
+    encodings = ['gzip']
+    if brotli is not None:
+        encodings.append('br')
+    return encodings
+
+
+def write_compressed_files(zip_file, manifest, old_manifest, root_dir,
+                           min_size=None):
+    """
+    Writes precompressed siblings (``.gz``, and ``.br`` if brotli is
+    available) of the served copy of every compressible static file in
+    ``manifest`` of at least ``min_size`` bytes (by default
+    ``UPLOADTEMPLATE_PRECOMPRESS_MIN_SIZE``), for front-end servers to send
+    to clients which accept them. The served copy is the one at the entry's
+    ``hashed_path``, if it has one, and otherwise at its ``path``.
+
+    Each entry's ``encodings`` records the paths of its siblings, relative
+    to ``root_dir``, keyed by content coding. Siblings which wouldn't be
+    smaller than the file itself are skipped, and files whose served copy
+    hasn't changed keep the siblings from ``old_manifest``. Files are
+    compressed in chunks, and may not be larger than
+    ``UPLOADTEMPLATE_MAX_FILE_SIZE`` bytes. Errors are raised together as a
+    :exc:`ThemeExtractionError`.
+
+    """
+    if min_size is None:
+        min_size = getattr(settings, 'UPLOADTEMPLATE_PRECOMPRESS_MIN_SIZE',
+                           1024)
+    encodings = get_precompress_encodings()
+    max_file_size = get_max_file_size()
+    errors = []
+    for name, entry in manifest.iteritems():
+        if (not name.startswith('static/') or entry['size'] < min_size or
+            not _is_compressible(entry['content_type'])):
+            continue
+        path = entry.get('hashed_path', entry.get('path', name))
+
+        old_entry = old_manifest.get(name) or {}
+        if (old_entry.get('encodings') is not None and
+            old_entry.get('hashed_path', old_entry.get('path', name)) == path):
+            entry['encodings'] = old_entry['encodings']
+            continue
+
+        try:
+            if 'hashed_path' in entry and _is_css(name):
+                # Rewritten CSS only exists in storage.
+                source = default_storage.open(root_dir + path)
+            else:
+                source = zip_file.open(name)
+            try:
+                size, compressed = _compress(source, encodings, name,
+                                             max_file_size)
+            finally:
+                source.close()
+
+            written = {}
+            try:
+                for encoding in encodings:
+                    fp = compressed[encoding]
+                    if fp.tell() >= size:
+                        continue
+                    sibling = '{0}.{1}'.format(path,
+                                               ENCODING_EXTENSIONS[encoding])
+                    content = File(fp, name=sibling)
+                    content.size = fp.tell()
+                    fp.seek(0)
+                    target = root_dir + sibling
+                    if default_storage.exists(target):
+                        default_storage.delete(target)
+                    default_storage.save(target, content)
+                    written[encoding] = sibling
+            finally:
+                for fp in compressed.itervalues():
+                    fp.close()
+        except Exception, e:
+            errors.append((name, e))
+        else:
+            entry['encodings'] = written
+
+    if errors:
+        raise ThemeExtractionError(errors)
+
+
+def _is_compressible(content_type):
+    return (content_type.startswith('text/') or
+            content_type in COMPRESSIBLE_TYPES)
+
+
+def _compress(source, encodings, filename, max_file_size):
+    """
+    Compresses ``source`` with each of ``encodings`` at once, reading it in
+    chunks and enforcing ``max_file_size`` against the bytes actually read.
+    Returns the number of bytes read and a dict mapping each encoding to a
+    temporary file holding the compressed copy, positioned at its end.
+
+    """
+    compressed, writers = {}, []
+    try:
+        for encoding in encodings:
+            fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            compressed[encoding] = fp
+            if encoding == 'br':
+                writers.append(_BrotliFile(fp))
+            else:
+                writers.append(gzip.GzipFile(fileobj=fp, mode='wb',
+                                             compresslevel=9))
+        size = 0
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if max_file_size is not None and size > max_file_size:
+                raise ThemeSizeError("{0} is larger than {1} bytes.".format(
+                                                    filename, max_file_size))
+            for writer in writers:
+                writer.write(chunk)
+        for writer in writers:
+            writer.close()
+    except:
+        for fp in compressed.itervalues():
+            fp.close()
+        raise
+    return size, compressed
+
+
+class _BrotliFile(object):
+    """
+    A write-only file which brotli-compresses what is written to it into
+    ``fileobj``. The compressed stream is finished by :meth:`close`.
+
+    """
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._compressor = brotli.Compressor()
+
+    def write(self, data):
+        self._fileobj.write(self._compressor.process(data))
+
+    def close(self):
+        self._fileobj.write(self._compressor.finish())
@@ -1,10 +1,13 @@
 import zipfile
 
 from django import forms
+from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.exceptions import ValidationError
 
+from uploadtemplate.extraction import get_max_file_size, get_max_total_size
 from uploadtemplate.models import Theme
+from uploadtemplate.tasks import schedule_extraction
 from uploadtemplate.utils import is_zipfile
 
 
@@ -34,6 +37,32 @@ class ThemeForm(forms.ModelForm):
             if n.startswith('/') or '..' in n.split('/'):
                 raise ValidationError('Zip archive contains invalid names.')
 
+        # Check the sizes recorded in the central directory, so that
+        # oversized archives are rejected without decompressing anything.
+        max_file_count = getattr(settings, 'UPLOADTEMPLATE_MAX_FILE_COUNT',
+                                 10000)
+        if max_file_count is not None and len(names) > max_file_count:
+            raise ValidationError('Zip archive contains too many files.')
+
+        infos = zip_file.infolist()
+        max_file_size = get_max_file_size()
+        max_total_size = get_max_total_size()
+        max_ratio = getattr(settings, 'UPLOADTEMPLATE_MAX_COMPRESSION_RATIO',
+                            100)
+        total_size = 0
+        for info in infos:
+            total_size += info.file_size
+            if max_file_size is not None and info.file_size > max_file_size:
+                raise ValidationError('Zip archive contains files which are '
+                                      'too large.')
+            if (max_ratio is not None and
+                info.file_size > max_ratio * max(info.compress_size, 1)):
+                raise ValidationError('Zip archive contains files which are '
+                                      'too highly compressed.')
+        if max_total_size is not None and total_size > max_total_size:
+            raise ValidationError('Zip archive is too large when '
+                                  'uncompressed.')
+
         return value
 
     def save(self, commit=True):
@@ -41,18 +70,23 @@ class ThemeForm(forms.ModelForm):
             raise ValueError("Cannot save an invalid upload.")
 
         self.instance.site = Site.objects.get_current()
+        files_changed = 'theme_files_zip' in self.changed_data
+        if files_changed:
+            # Themes keep serving their previous revision while new files
+            # are extracted, but new themes have nothing to serve yet.
+            self.instance.status = Theme.PENDING
+            if self.instance.pk is None:
+                self.instance.servable = False
         instance = super(ThemeForm, self).save(commit=False)
 
         old_save_m2m = self.save_m2m
 
         def save_m2m():
-            if instance.default:
-                Theme.objects.exclude(pk=instance.pk
-                            ).filter(default=True
-                            ).update(default=False)
             old_save_m2m()
-            instance.save_files()
-            instance.prune_files()
+            if instance.default:
+                instance.activate()
+            if files_changed:
+                schedule_extraction(instance)
 
         if commit:
             instance.save()
@@ -0,0 +1,289 @@
+"""
+Counts and timings for the operations on uploadtemplate's hot paths: theme
+lookups that miss the in-process cache, listings of theme files, reads of
+theme templates and calls to the default storage.
+
+Every timed operation sends :data:`~uploadtemplate.signals.operation_timed`
+and is added to any :class:`Collector` active in the current thread (see
+:func:`collect`). Operations which take at least
+``UPLOADTEMPLATE_SLOW_LOOKUP_THRESHOLD`` seconds are logged as warnings to
+the ``uploadtemplate.instrumentation`` logger, with the operation, its
+duration and details as extra fields on the log record.
+
+Storage calls are only timed once the default storage has been wrapped by
+:func:`instrument_storage`, which :class:`InstrumentationMiddleware` does
+when it is loaded.
+
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from timeit import default_timer
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils.functional import empty
+
+from uploadtemplate.signals import operation_timed
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Storage methods which are timed by InstrumentedStorage.
+STORAGE_METHODS = frozenset([
+    'open', 'save', 'delete', 'exists', 'listdir', 'size', 'url',
+    'accessed_time', 'created_time', 'modified_time', 'list_prefix',
+    'delete_many',
+])
+
+
+class Collector(object):
+    """
+    Accumulates the number of times each operation was performed, and the
+    total time spent on it in seconds.
+
+    """
+    def __init__(self):
+        self.counts = {}
+        self.durations = {}
+
+    def add(self, operation, duration):
+        self.counts[operation] = self.counts.get(operation, 0) + 1
+        self.durations[operation] = (self.durations.get(operation, 0) +
+                                     duration)
+
+    def count(self, prefix=''):
+        """
+        Returns the number of operations whose names start with ``prefix``,
+        e.g. ``'storage.'`` for storage calls.
+
+        """
+        return sum(count for operation, count in self.counts.iteritems()
+                   if operation.startswith(prefix))
+
+    def duration(self, prefix=''):
+        """
+        Returns the total time in seconds spent on operations whose names
+        start with ``prefix``.
+
+        """
+        return sum(duration
+                   for operation, duration in self.durations.iteritems()
+                   if operation.startswith(prefix))
+
+    def summary(self):
+        """
+        Returns a dictionary mapping each operation to a ``(count, total
+        milliseconds)`` tuple.
+
+        """
+        return dict((operation, (count, self.durations[operation] * 1000))
+                    for operation, count in self.counts.iteritems())
+
+
+def _collectors():
+    collectors = getattr(_local, 'collectors', None)
+    if collectors is None:
+        collectors = _local.collectors = []
+    return collectors
+
+
+def start_collecting(collector=None):
+    """
+    Starts adding operations in the current thread to ``collector`` (or a
+    new :class:`Collector`), and returns it.
+
+    """
+    if collector is None:
+        collector = Collector()
+    _collectors().append(collector)
+    return collector
+
+
+def stop_collecting(collector):
+    collectors = _collectors()
+    if collector in collectors:
+        collectors.remove(collector)
+
+
+@contextmanager
+def collect():
+    """
+    Yields a :class:`Collector` of the operations performed in the current
+    thread within the block.
+
+    """
+    collector = start_collecting()
+    try:
+        yield collector
+    finally:
+        stop_collecting(collector)
+
+
+def record(operation, duration, **details):
+    """
+    Records that ``operation`` took ``duration`` seconds.
+
+    """
+    for collector in _collectors():
+        collector.add(operation, duration)
+    operation_timed.send(sender=None, operation=operation, duration=duration,
+                         details=details)
+    threshold = getattr(settings, 'UPLOADTEMPLATE_SLOW_LOOKUP_THRESHOLD',
+                        None)
+    if threshold is not None and duration >= threshold:
+        logger.warning("Slow %s: %.1fms", operation, duration * 1000,
+                       extra={'operation': operation, 'duration': duration,
+                              'details': details})
+
+
+class timed(object):
+    """
+    Context manager which records the time taken by its block as
+    ``operation``. Any keyword arguments are passed along as details.
+
+    """
+    def __init__(self, operation, **details):
+        self.operation = operation
+        self.details = details
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record(self.operation, default_timer() - self.start, **self.details)
+        return False
+
+
+class InstrumentedStorage(object):
+    """
+    Wraps a storage, timing calls to the methods in :data:`STORAGE_METHODS`
+    as ``storage.<method>`` operations. Anything else is passed straight
+    through.
+
+    """
+    def __init__(self, storage):
+        self.__dict__['storage'] = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self.storage, name)
+        if name not in STORAGE_METHODS or not callable(attr):
+            return attr
+        operation = 'storage.' + name
+
+        def method(*args, **kwargs):
+            with timed(operation, args=args):
+                return attr(*args, **kwargs)
+        return method
+
+    def __setattr__(self, name, value):
+        setattr(self.storage, name, value)
+
+
+def instrument_storage():
+    """
+    Wraps the default storage in an :class:`InstrumentedStorage`. Returns
+    ``False`` if it was already wrapped.
+
+    """
+    if default_storage._wrapped is empty:
+        default_storage._setup()
+    if isinstance(default_storage._wrapped, InstrumentedStorage):
+        return False
+    default_storage._wrapped = InstrumentedStorage(default_storage._wrapped)
+    return True
+
+
+def uninstrument_storage():
+    """
+    Undoes :func:`instrument_storage`.
+
+    """
+    if isinstance(default_storage._wrapped, InstrumentedStorage):
+        default_storage._wrapped = default_storage._wrapped.storage
+
+
+@contextmanager
+def storage_calls():
+    """
+    Yields a :class:`Collector` of the operations, including storage calls,
+    performed in the current thread within the block.
+
+    """
+    installed = instrument_storage()
+    try:
+        with collect() as collector:
+            yield collector
+    finally:
+        if installed:
+            uninstrument_storage()
+
+
+class _AssertNumStorageCallsContext(object):
+    def __init__(self, test_case, num):
+        self.test_case = test_case
+        self.num = num
+
+    def __enter__(self):
+        self.context = storage_calls()
+        self.collector = self.context.__enter__()
+        return self.collector
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.context.__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return False
+        calls = dict((operation, count)
+                     for operation, count in self.collector.counts.iteritems()
+                     if operation.startswith('storage.'))
+        self.test_case.assertEqual(
+            sum(calls.itervalues()), self.num,
+            "{0} storage calls made, {1} expected: {2!r}".format(
+                sum(calls.itervalues()), self.num, calls))
+        return False
+
+
+class StorageCallsTestMixin(object):
+    """
+    Adds :meth:`assertNumStorageCalls` to a test case.
+
+    """
+    def assertNumStorageCalls(self, num, func=None, *args, **kwargs):
+        """
+        Like :meth:`assertNumQueries`, but for calls to the default storage.
+        Can be used as a context manager or called with a function and its
+        arguments.
+
+        """
+        context = _AssertNumStorageCallsContext(self, num)
+        if func is None:
+            return context
+        with context:
+            func(*args, **kwargs)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Collects the operations performed while handling each request into a
+    :class:`Collector`, available as ``request.uploadtemplate_operations``,
+    and logs a summary of them at debug level.
+
+    """
+    def __init__(self):
+        instrument_storage()
+
+    def process_request(self, request):
+        request.uploadtemplate_operations = start_collecting()
+
+    def process_response(self, request, response):
+        collector = getattr(request, 'uploadtemplate_operations', None)
+        if collector is not None:
+            stop_collecting(collector)
+            if collector.counts:
+                logger.debug("%s %s: %s", request.method, request.path,
+                             collector.summary(),
+                             extra={'operations': collector.summary()})
+        return response
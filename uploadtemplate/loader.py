@@ -2,10 +2,19 @@ import os
 
 from django.core.files.storage import default_storage
 from django.template import TemplateDoesNotExist
+from django.template.loader import get_template_from_string, make_origin
 from django.template.loaders import filesystem
 
+from uploadtemplate.cache import (template_source_cache,
+                                  compiled_template_cache,
+                                  get_template_manifest, get_zip_reader)
+from uploadtemplate.instrumentation import timed
 from uploadtemplate.models import Theme
-from uploadtemplate.utils import is_protected_template
+from uploadtemplate.utils import is_protected_template, serve_from_zip
+
+
+_missing = object()
+
 
 class Loader(filesystem.Loader):
     def load_template_source(self, template_name, dirs=None):
@@ -13,21 +22,113 @@ class Loader(filesystem.Loader):
             theme = Theme.objects.get_current()
         except Theme.DoesNotExist:
             raise TemplateDoesNotExist, 'no default theme'
+        return self.load_theme_template_source(theme, template_name)
+
+    load_template_source.is_usable = True
+
+    def load_theme_template_source(self, theme, template_name):
+        """
+        Like :meth:`load_template_source`, but for ``theme`` rather than the
+        current theme.
 
+        """
         if is_protected_template(template_name):
             raise TemplateDoesNotExist('Template name is protected')
 
+        # Most templates aren't provided by the theme at all; those are
+        # turned away using the theme's lists of templates, without going
+        # near storage or the filesystem.
+        theme_templates, legacy_templates = get_template_manifest(theme)
+
         # Try the new location first.
-        name = os.path.join(theme.theme_files_dir, 'templates', template_name)
-        if default_storage.exists(name):
+        if template_name in theme_templates:
+            key = (theme.pk, theme.revision, template_name)
+            result = template_source_cache.get(key, _missing)
+            if result is _missing:
+                with timed('template_read', theme=theme.pk,
+                           template_name=template_name):
+                    if serve_from_zip():
+                        result = self._load_from_zip(theme, template_name)
+                    else:
+                        result = self._load_from_storage(theme,
+                                                         template_name)
+                template_source_cache.set(key, result)
+            if result is not None:
+                return result
+
+        # Then fall back on the old location.
+        if template_name in legacy_templates:
+            return super(Loader, self).load_template_source(
+                                    template_name, [theme.template_dir()])
+
+        raise TemplateDoesNotExist(template_name)
+
+    def _load_from_zip(self, theme, template_name):
+        if not theme.theme_files_zip:
+            return None
+        reader = get_zip_reader(theme)
+        name = os.path.join('templates', template_name)
+        if name not in reader:
+            return None
+        return (reader.read(name),
+                '{zip}:{name}'.format(zip=theme.theme_files_zip.name,
+                                      name=name))
+
+    def _load_from_storage(self, theme, template_name):
+        name = theme.get_file_name(os.path.join('templates', template_name))
+        if name is None:
+            return None
+        try:
             fp = default_storage.open(name)
+        except (IOError, OSError):
+            # Removed since the theme's files were listed.
+            return None
+        try:
             return (fp.read(), name)
+        finally:
+            fp.close()
 
-        # Then fall back on the old location.
-        return super(Loader, self).load_template_source(template_name,
-                                                        [theme.template_dir()])
 
-    load_template_source.is_usable = True
+class CachedLoader(Loader):
+    """
+    Like :class:`Loader`, but also keeps the compiled templates for the
+    current theme, so that each template is only parsed once per theme
+    revision.
+
+    """
+    def load_template(self, template_name, template_dirs=None):
+        try:
+            theme = Theme.objects.get_current()
+        except Theme.DoesNotExist:
+            raise TemplateDoesNotExist, 'no default theme'
+        return self.load_theme_template(theme, template_name)
+
+    def load_theme_template(self, theme, template_name):
+        """
+        Like :meth:`load_template`, but for ``theme`` rather than the
+        current theme.
+
+        """
+        key = (theme.pk, theme.revision, template_name)
+        template = compiled_template_cache.get(key)
+        if template is None:
+            source, display_name = self.load_theme_template_source(
+                                                        theme, template_name)
+            origin = make_origin(display_name, self.load_template_source,
+                                 template_name, None)
+            try:
+                template = get_template_from_string(source, origin,
+                                                    template_name)
+            except TemplateDoesNotExist:
+                # The template extends or includes one which doesn't exist;
+                # like Django's loaders, hand back the source so that the
+                # missing template is reported. Don't cache it.
+                return source, display_name
+            compiled_template_cache.set(key, template)
+        return template, None
+
+    def reset(self):
+        compiled_template_cache.clear()
 
 _loader = Loader()
 
@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import CommandError, NoArgsCommand
+
+from uploadtemplate.benchmark import DEFAULT_SIZES, run_benchmarks
+
+
+class Command(NoArgsCommand):
+    help = ("Benchmarks template lookup, static URL resolution, extraction "
+            "and pruning for synthetic themes, against an in-memory storage "
+            "with simulated latency. Creates (and then deletes) a temporary "
+            "site and themes in the database.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', action='store', dest='sizes',
+                    default=','.join(str(size) for size in DEFAULT_SIZES),
+                    help='Comma-separated numbers of files per theme.'),
+        make_option('--iterations', action='store', type='int',
+                    dest='iterations', default=200,
+                    help='Number of times to repeat each lookup.'),
+        make_option('--latency', action='store', type='float',
+                    dest='latency', default=0,
+                    help='Milliseconds to add to every storage call.'),
+        make_option('--flat', action='store_true', dest='flat',
+                    default=False,
+                    help='Simulate a storage which can list and delete '
+                         'many files in one call.'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("--sizes must be a comma-separated list of "
+                               "numbers.")
+        if any(size < 2 for size in sizes):
+            raise CommandError("Themes need at least two files.")
+        for result in run_benchmarks(sizes, options['iterations'],
+                                     options['latency'] / 1000.0,
+                                     options['flat']):
+            self.stdout.write(result.format() + '\n')
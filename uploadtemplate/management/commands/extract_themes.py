@@ -0,0 +1,36 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import NoArgsCommand
+
+from uploadtemplate.tasks import extract_pending_themes, prune_due_themes
+
+
+class Command(NoArgsCommand):
+    help = ("Extracts the files of themes which are waiting to be extracted, "
+            "and removes old revisions which are due to be pruned. Used "
+            "with UPLOADTEMPLATE_EXTRACTION = 'queue'.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Keep polling for pending themes.'),
+        make_option('--interval', action='store', type='float',
+                    dest='interval', default=5,
+                    help='Seconds to wait between polls with --loop.'),
+        make_option('--database', action='store', dest='database',
+                    default='default',
+                    help='Database to look for pending themes in.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            count = extract_pending_themes(using=options['database'])
+            if count and verbosity >= 1:
+                self.stdout.write("Extracted {0} theme(s).\n".format(count))
+            count = prune_due_themes(using=options['database'])
+            if count and verbosity >= 1:
+                self.stdout.write("Pruned {0} theme(s).\n".format(count))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from uploadtemplate.tasks import prune_due_themes
+
+
+class Command(NoArgsCommand):
+    help = ("Removes the files of themes' old revisions which are due to be "
+            "pruned, in case the process which extracted them exited "
+            "before it could. Run it periodically unless a worker runs "
+            "manage.py extract_themes --loop, which does this too.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default='default',
+                    help='Database to look for themes in.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        count = prune_due_themes(using=options['database'])
+        if count and verbosity >= 1:
+            self.stdout.write("Pruned {0} theme(s).\n".format(count))
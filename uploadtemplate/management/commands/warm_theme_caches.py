@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from uploadtemplate.warmup import warm_up
+
+
+class Command(NoArgsCommand):
+    help = ("Fills the in-process caches for every site's default theme and "
+            "reports how long each step took. Mostly useful for checking "
+            "what a new process pays before its first request; to warm a "
+            "serving process, call uploadtemplate.warmup.warm_up() from "
+            "its wsgi.py.")
+    option_list = NoArgsCommand.option_list + (
+        make_option('--compile', action='store_true', dest='compile',
+                    default=False,
+                    help='Also compile every theme template.'),
+        make_option('--database', action='store', dest='database',
+                    default='default',
+                    help='Database to look up themes in.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        results = warm_up(compile_templates=options['compile'],
+                          using=options['database'])
+        if verbosity >= 1:
+            for result in results:
+                self.stdout.write(result.format() + '\n')
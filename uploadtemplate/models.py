@@ -1,16 +1,21 @@
+import json
 import os
-import shutil
+import time
 import zipfile
 
 from django.conf import settings
 from django.contrib.sites.models import Site
-from django.core.files.base import ContentFile
-from django.core.files.storage import default_storage
-from django.core.signals import request_finished
-from django.db import models
+from django.core.cache import get_cache
+from django.db import models, transaction
+from django.utils import timezone
 
 
-from uploadtemplate.utils import list_files
+from uploadtemplate.extraction import (extract_files, write_compressed_files,
+                                       write_hashed_files)
+from uploadtemplate.instrumentation import timed
+from uploadtemplate.signals import theme_files_changed
+from uploadtemplate.utils import (delete_files, iter_files, get_zip_manifest,
+                                  remove_local_dir, serve_from_zip)
 
 
 class ThemeManager(models.Manager):
@@ -22,13 +27,15 @@ class ThemeManager(models.Manager):
         if isinstance(site, Site):
             site = site.pk
         site_pk = int(site)
-        if (using, site_pk) not in self._cache:
-            try:
-                theme = self.get(site=site_pk, default=True)
-            except self.model.DoesNotExist:
-                theme = None
-            self._cache[(using, site_pk)] = theme
-        theme = self._cache[(using, site_pk)]
+        # Entries are (theme, expires) tuples. Saves and deletes in this
+        # process update the entry immediately; changes made elsewhere are
+        # picked up once the entry expires.
+        entry = self._cache.get((using, site_pk))
+        if entry is None or entry[1] <= time.time():
+            with timed('theme_lookup', site=site_pk, using=using):
+                entry = self._make_entry(self._get_default(site_pk, using))
+            self._cache[(using, site_pk)] = entry
+        theme = entry[0]
         if theme is None:
             raise self.model.DoesNotExist
         return theme
@@ -45,12 +52,93 @@ class ThemeManager(models.Manager):
     def clear_cache(self):
         self._cache = {}
 
+    def invalidate(self, site, using='default'):
+        """
+        Forgets the cached default theme for the given site, both locally and
+        in the shared cache (if any). Use this after bulk updates which don't
+        send ``post_save``.
+
+        """
+        if isinstance(site, Site):
+            site = site.pk
+        site_pk = int(site)
+        self._cache.pop((using, site_pk), None)
+        self._bump_shared_version(site_pk, using)
+
+    def _make_entry(self, theme):
+        interval = getattr(settings, 'UPLOADTEMPLATE_THEME_CHECK_INTERVAL', 5)
+        return (theme, time.time() + interval)
+
+    def _get_default(self, site_pk, using):
+        shared_cache = self._get_shared_cache()
+        if shared_cache is not None:
+            key = self._shared_key(shared_cache, site_pk, using)
+            # Themes are wrapped in a tuple so that a cached "no default
+            # theme" can be told apart from a cache miss.
+            cached = shared_cache.get(key)
+            if cached is not None:
+                return cached[0]
+
+        # A theme marked as default only takes over once it has files to
+        # serve; until then the previous default stays current.
+        try:
+            theme = self.get(site=site_pk, default=True, servable=True)
+        except self.model.DoesNotExist:
+            theme = None
+
+        if shared_cache is not None:
+            shared_cache.set(key, (theme,))
+        return theme
+
+    def _get_shared_cache(self):
+        """
+        Returns the cache backend named by ``UPLOADTEMPLATE_THEME_CACHE``, or
+        ``None`` if themes should only be cached in this process.
+
+        """
+        alias = getattr(settings, 'UPLOADTEMPLATE_THEME_CACHE', None)
+        if alias is None:
+            return None
+        return get_cache(alias)
+
+    def _shared_version_key(self, site_pk, using):
+        return 'uploadtemplate.theme.version:{using}:{site}'.format(
+                                                    using=using, site=site_pk)
+
+    def _shared_key(self, shared_cache, site_pk, using):
+        version_key = self._shared_version_key(site_pk, using)
+        version = shared_cache.get(version_key)
+        if version is None:
+            # Start from the current time rather than from 1, so that an
+            # evicted version counter can't bring back stale entries.
+            shared_cache.add(version_key, int(time.time() * 1000))
+            version = shared_cache.get(version_key)
+        return 'uploadtemplate.theme:{using}:{site}:{version}'.format(
+                                using=using, site=site_pk, version=version)
+
+    def _bump_shared_version(self, site_pk, using):
+        shared_cache = self._get_shared_cache()
+        if shared_cache is None:
+            return
+        version_key = self._shared_version_key(site_pk, using)
+        try:
+            shared_cache.incr(version_key)
+        except ValueError:
+            shared_cache.set(version_key, int(time.time() * 1000))
+
     def _post_save(self, sender, instance, created, raw, using, **kwargs):
-        if instance.default:
-            self._cache[(using, instance.site_id)] = instance
+        current = instance.default and instance.servable
+        if current:
+            self._cache[(using, instance.site_id)] = self._make_entry(instance)
         elif ((using, instance.site_id) in self._cache and
-              self._cache[(using, instance.site_id)] == instance):
-            self._cache[(using, instance.site_id)] = None
+              self._cache[(using, instance.site_id)][0] == instance):
+            self._cache[(using, instance.site_id)] = self._make_entry(None)
+        self._bump_shared_version(instance.site_id, using)
+        if current:
+            shared_cache = self._get_shared_cache()
+            if shared_cache is not None:
+                key = self._shared_key(shared_cache, instance.site_id, using)
+                shared_cache.set(key, (instance,))
 
     def contribute_to_class(self, model, name):
         # In addition to the normal contributions, we also attach a post-save
@@ -62,6 +150,17 @@ class ThemeManager(models.Manager):
 
 
 class Theme(models.Model):
+    PENDING = 'pending'
+    EXTRACTING = 'extracting'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (EXTRACTING, 'Extracting'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    )
+
     site = models.ForeignKey('sites.Site')
     name = models.CharField(max_length=255)
     theme_files_zip = models.FileField(upload_to='uploadtemplate/files/%Y/%m/%d',
@@ -71,6 +170,25 @@ class Theme(models.Model):
                         blank=True)
     description = models.TextField(blank=True)
     default = models.BooleanField(default=False)
+    # JSON-encoded manifest of the extracted theme files. See get_manifest.
+    manifest = models.TextField(blank=True, editable=False)
+    # Whether the theme's files are ready to be served. See
+    # uploadtemplate.tasks.
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=READY, editable=False)
+    # When the current extraction was claimed by a worker.
+    extraction_started = models.DateTimeField(null=True, blank=True,
+                                              editable=False)
+    # Whether the theme has files which can be served. Set once its first
+    # extraction succeeds, and kept while later uploads are extracted (or
+    # fail to be), since the previous revision is still in place.
+    servable = models.BooleanField(default=True, editable=False)
+    # The revision of the theme's files currently being served. Each
+    # extraction writes to a new revision; see theme_files_dir.
+    revision = models.PositiveIntegerField(default=0, editable=False)
+    # When the files of the theme's old revisions are due to be removed, if
+    # they haven't been yet. See uploadtemplate.tasks.schedule_pruning.
+    prune_after = models.DateTimeField(null=True, blank=True, editable=False)
 
     objects = ThemeManager()
 
@@ -86,75 +204,283 @@ class Theme(models.Model):
 
     @property
     def theme_files_dir(self):
+        """
+        The directory holding the files of the theme's current revision.
+        Revision 0 is the theme's root directory, where themes were extracted
+        before revisions were introduced.
+
+        """
+        if not self.revision:
+            return self.theme_root_dir
+        return '{root}{revision}/'.format(root=self.theme_root_dir,
+                                          revision=self.revision)
+
+    @property
+    def theme_root_dir(self):
         if self.pk is None:
             raise AttributeError("Themes with no pk have no theme files directory.")
         return 'uploadtemplate/themes/{pk}/'.format(pk=self.pk)
 
+    def get_manifest(self):
+        """
+        Returns a dictionary describing the files extracted from the theme's
+        zip file, keyed by their path within the zip file. Each entry has the
+        file's ``size``, ``crc`` and ``content_type``, and the ``path`` of
+        its copy in storage relative to :attr:`theme_root_dir` (if missing,
+        the file is at its name in revision 0). Static files may also have
+        a ``hashed_path``, for a copy named after a hash of its contents,
+        and ``encodings``, mapping content codings to the paths of
+        precompressed copies.
+        Returns ``None`` if no
+        manifest has been recorded, in which case the storage is the only
+        source of truth.
+
+        """
+        if not self.manifest:
+            return None
+        parsed = getattr(self, '_parsed_manifest', None)
+        if parsed is None or parsed[0] is not self.manifest:
+            parsed = (self.manifest, json.loads(self.manifest))
+            self._parsed_manifest = parsed
+        return parsed[1]
+
+    def get_file_name(self, name, hashed=False):
+        """
+        Returns the storage name for ``name``, a path within the theme's zip
+        file. If the manifest shows that the theme has no such file, returns
+        ``None``; without a manifest, the name in the current revision's
+        directory is returned whether or not the file exists.
+
+        If ``hashed`` is ``True``, the name of the file's content-hashed copy
+        is returned instead, where it has one.
+
+        """
+        manifest = self.get_manifest()
+        if manifest is None:
+            return os.path.join(self.theme_files_dir, name)
+        entry = manifest.get(name)
+        if entry is None:
+            return None
+        if hashed and 'hashed_path' in entry:
+            return os.path.join(self.theme_root_dir, entry['hashed_path'])
+        return os.path.join(self.theme_root_dir, entry.get('path', name))
+
     def save_files(self):
+        """
+        Extracts the theme's zip file into the directory of a new revision,
+        then switches the theme over to that revision in a single update.
+        Requests rendered in the meantime keep seeing the previous revision;
+        its files are removed later by :meth:`prune_files`.
+
+        Templates are only written if they were added or changed since the
+        previous extraction (according to the manifest); the new revision's
+        manifest points at the existing copies of the others. Static files
+        are all written to each revision, so that the relative references
+        between them keep working.
+
+        If ``UPLOADTEMPLATE_HASH_STATIC_FILES`` is set, content-hashed copies
+        of the static files are written as well; see
+        :func:`~uploadtemplate.extraction.write_hashed_files`. Likewise
+        ``UPLOADTEMPLATE_PRECOMPRESS_STATIC_FILES`` adds compressed copies;
+        see :func:`~uploadtemplate.extraction.write_compressed_files`.
+
+        Raises :exc:`~uploadtemplate.extraction.ThemeExtractionError` if any
+        file couldn't be written; the theme then stays on its old revision.
+
+        """
         if not self.theme_files_zip:
             return
 
+        from uploadtemplate.tasks import schedule_pruning
+
+        if serve_from_zip():
+            # Theme files are read straight from the zip file, so there is
+            # nothing to extract; a new revision drops anything cached for
+            # the old zip file, and any files extracted before are pruned.
+            self._set_revision(self.revision + 1, self.manifest)
+            schedule_pruning(self)
+            return
+
         zip_file = zipfile.ZipFile(self.theme_files_zip)
+        old_manifest = self.get_manifest() or {}
+        manifest = get_zip_manifest(zip_file)
+        revision = self.revision + 1
 
-        # Unzip and replace any files.
-        for filename in zip_file.namelist():
-            # skip any zipped directories.
-            if filename.endswith('/'):
+        # Unzip any new or changed files. Static files refer to each other
+        # by relative paths, so every revision needs all of them; unchanged
+        # templates, which are looked up by name, are left where they are.
+        changed = []
+        extracted = []
+        for filename, entry in manifest.iteritems():
+            old_entry = old_manifest.get(filename)
+            if (old_entry is None or
+                old_entry['size'] != entry['size'] or
+                old_entry['crc'] != entry['crc']):
+                changed.append(filename)
+            elif not filename.startswith('static/'):
+                entry['path'] = old_entry.get('path', filename)
                 continue
-            name = os.path.join(self.theme_files_dir, filename)
-            fp = ContentFile(zip_file.read(filename))
-            if default_storage.exists(name):
-                default_storage.delete(name)
-            default_storage.save(name, fp)
+            extracted.append(filename)
+            entry['path'] = '{0}/{1}'.format(revision, filename)
+
+        if not changed and set(manifest) == set(old_manifest):
+            return
+
+        revision_dir = '{root}{revision}/'.format(root=self.theme_root_dir,
+                                                  revision=revision)
+        extract_files(zip_file, extracted, revision_dir)
+        if getattr(settings, 'UPLOADTEMPLATE_HASH_STATIC_FILES', False):
+            write_hashed_files(zip_file, manifest, old_manifest, changed,
+                               self.theme_root_dir, revision)
+        if getattr(settings, 'UPLOADTEMPLATE_PRECOMPRESS_STATIC_FILES', False):
+            write_compressed_files(zip_file, manifest, old_manifest,
+                                   self.theme_root_dir)
+        self._set_revision(revision, json.dumps(manifest, sort_keys=True))
+        schedule_pruning(self)
+
+    def _set_revision(self, revision, manifest):
+        using = self._state.db or 'default'
+        Theme.objects.using(using).filter(pk=self.pk).update(
+                                        revision=revision, manifest=manifest)
+        self.revision = revision
+        self.manifest = manifest
+        Theme.objects.invalidate(self.site_id, using)
+        theme_files_changed.send(sender=self.__class__, instance=self)
+
+    def update_files(self):
+        """
+        Brings the theme's files in storage up to date with its zip file.
+
+        """
+        # Without a manifest from a previous extraction, we don't know which
+        # files are in storage, so they all need to be checked. If the theme
+        # moved to a new revision, that's already been scheduled; pruning
+        # now would pull files from under requests still using them.
+        needs_pruning = (self.get_manifest() is None or
+                         not self.theme_files_zip)
+        revision = self.revision
+        self.save_files()
+        if needs_pruning and self.revision == revision:
+            self.prune_files()
+
+    def activate(self):
+        """
+        Marks the theme as its site's default. If it has files to serve, it
+        replaces the current default immediately; otherwise that happens
+        once its first extraction succeeds.
+
+        """
+        self.default = True
+        using = self._state.db or 'default'
+        with transaction.commit_on_success(using=using):
+            if self.servable:
+                Theme.objects.using(using).exclude(pk=self.pk).filter(
+                                site=self.site_id, default=True
+                                ).update(default=False)
+            self.save(using=using)
+
+    def iter_files(self):
+        """
+        Yields the names of the theme's files in storage, across all
+        revisions.
+
+        """
+        return iter_files(self.theme_root_dir)
 
     def list_files(self):
-        return list_files(self.theme_files_dir)
+        """
+        Lists the theme's files in storage, across all revisions.
+
+        """
+        return list(self.iter_files())
 
     def prune_files(self):
         """
-        Removes files from the theme's directory that aren't in the theme's
-        zipfile.
+        Removes files from the theme's directory that aren't part of the
+        theme's current revision. Files belonging to later revisions, which
+        may still be being extracted, are left alone.
 
         """
-        if self.theme_files_zip:
-            zip_file = zipfile.ZipFile(self.theme_files_zip)
-            expected_files = set((os.path.join(self.theme_files_dir, name)
-                                  for name in zip_file.namelist()))
+        now = timezone.now()
+        if not self.theme_files_zip:
+            self.delete_files()
         else:
+            self._prune_files()
+        # Any pruning which was due has now been done.
+        using = self._state.db or 'default'
+        Theme.objects.using(using).filter(pk=self.pk, prune_after__lte=now
+                                          ).update(prune_after=None)
+        if self.prune_after is not None and self.prune_after <= now:
+            self.prune_after = None
+
+    def _prune_files(self):
+
+        manifest = self.get_manifest()
+        if manifest is not None:
             expected_files = set()
+            for name, entry in manifest.iteritems():
+                expected_files.add(self.get_file_name(name))
+                expected_files.add(self.get_file_name(name, hashed=True))
+                for path in entry.get('encodings', {}).itervalues():
+                    expected_files.add(os.path.join(self.theme_root_dir,
+                                                    path))
+        else:
+            zip_file = zipfile.ZipFile(self.theme_files_zip)
+            expected_files = set(os.path.join(self.theme_files_dir, name)
+                                 for name in zip_file.namelist())
 
-        found_files = set(self.list_files())
-        to_prune = found_files - expected_files
-        for name in to_prune:
-            default_storage.delete(name)
+        root = self.theme_root_dir
+
+        def stale_files():
+            for name in self.iter_files():
+                if name in expected_files:
+                    continue
+                first = name[len(root):].split('/', 1)[0]
+                revision = int(first) if first.isdigit() else 0
+                if revision <= self.revision:
+                    yield name
+
+        # Files are deleted in batches as they're found, rather than after
+        # listing the whole directory.
+        if delete_files(stale_files()):
+            theme_files_changed.send(sender=self.__class__, instance=self)
 
     def delete_files(self):
         """
         Removes all files from the theme's directory.
 
         """
-        for name in self.list_files():
-            default_storage.delete(name)
+        delete_files(self.iter_files())
+        if self.manifest:
+            self._set_revision(self.revision, '')
+        else:
+            theme_files_changed.send(sender=self.__class__, instance=self)
 
     def delete(self, *args, **kwargs):
-        self.delete_files()
-        # Backwards-compat: Try to delete the old directories too.
-        try:
-            shutil.rmtree(self.static_root())
-        except OSError, e:
-            if e.errno == 2: # no such file:
-                pass
-            else:
-                raise
-        try:
-            shutil.rmtree(self.template_dir())
-        except OSError, e:
-            if e.errno == 2: # no such file
-                pass
-            else:
-                raise
-        Theme.objects._post_save(None, self, None, None, using=self._state.db)
+        """
+        Deletes the theme along with its files. If
+        ``UPLOADTEMPLATE_DEFER_FILE_DELETION`` is set, the files are removed
+        afterwards by a background thread instead.
+
+        """
+        # Backwards-compat: Delete the old directories too.
+        legacy_dirs = [self.static_root(), self.template_dir()]
+        root_dir = self.theme_root_dir
+        defer = getattr(settings, 'UPLOADTEMPLATE_DEFER_FILE_DELETION', False)
+        if defer:
+            # Caches are keyed by pk, which the theme loses once deleted.
+            theme_files_changed.send(sender=self.__class__, instance=self)
+        else:
+            self.delete_files()
+            for path in legacy_dirs:
+                remove_local_dir(path)
+        using = self._state.db or 'default'
+        site_id = self.site_id
         super(Theme, self).delete(*args, **kwargs)
+        Theme.objects.invalidate(site_id, using)
+        if defer:
+            from uploadtemplate.tasks import schedule_sweep
+            schedule_sweep(root_dir, legacy_dirs)
 
     # Required for backwards-compatibility shims for get_static_url.
     def static_root(self):
@@ -168,7 +494,3 @@ class Theme(models.Model):
     def template_dir(self):
         return '%stemplates/%i/' % (settings.UPLOADTEMPLATE_MEDIA_ROOT,
                                      self.pk)
-
-def finished(sender, **kwargs):
-    Theme.objects.clear_cache()
-request_finished.connect(finished)
@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+
+#: Sent whenever files belonging to a theme are written to or removed from
+#: storage. Caches of theme contents should be invalidated when it fires.
+theme_files_changed = Signal(providing_args=['instance'])
+
+#: Sent whenever an instrumented operation finishes; see
+#: :mod:`uploadtemplate.instrumentation`. ``operation`` is its name,
+#: ``duration`` the time it took in seconds, and ``details`` a dictionary of
+#: whatever else is known about it.
+operation_timed = Signal(providing_args=['operation', 'duration', 'details'])
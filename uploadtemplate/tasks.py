@@ -0,0 +1,266 @@
+"""
+Extraction of uploaded themes, optionally off the request path.
+
+``UPLOADTEMPLATE_EXTRACTION`` controls when a newly-uploaded zip file is
+extracted:
+
+``'sync'`` (the default)
+    Straight away, in the request which uploaded it.
+``'thread'``
+    In a background thread of the process which uploaded it.
+``'queue'``
+    By a separate worker running ``manage.py extract_themes``. The theme
+    table itself is the queue: themes waiting to be extracted are marked
+    as pending.
+
+A theme is never served until its first extraction has succeeded, even if
+it has been made the default. While later uploads are being extracted, or
+if their extraction fails, it keeps serving its previous revision.
+
+"""
+import logging
+import threading
+import time
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from uploadtemplate.models import Theme
+from uploadtemplate.utils import delete_files, iter_files, remove_local_dir
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait before each attempt to claim a theme for extraction in a
+# background thread.
+CLAIM_RETRY_DELAYS = (0, 0.5, 1, 2, 4, 8)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_mode():
+    return getattr(settings, 'UPLOADTEMPLATE_EXTRACTION', 'sync')
+
+
+def schedule_extraction(theme):
+    """
+    Marks the theme as pending and arranges for its files to be extracted
+    according to ``UPLOADTEMPLATE_EXTRACTION``.
+
+    """
+    using = theme._state.db or 'default'
+    theme.status = Theme.PENDING
+    Theme.objects.using(using).filter(pk=theme.pk).update(status=Theme.PENDING)
+
+    mode = get_extraction_mode()
+    if mode == 'sync':
+        try:
+            extract_theme(theme.pk, using, raise_errors=True)
+        finally:
+            # Bring the instance up to date with what the extraction wrote.
+            current = Theme.objects.using(using).get(pk=theme.pk)
+            for field in ('status', 'servable', 'revision', 'manifest',
+                          'prune_after', 'extraction_started'):
+                setattr(theme, field, getattr(current, field))
+    elif mode == 'thread':
+        _get_pool().apply_async(_extract_in_thread, (theme.pk, using))
+    elif mode != 'queue':
+        raise ValueError("Unknown UPLOADTEMPLATE_EXTRACTION mode: "
+                         "{0!r}".format(mode))
+
+
+def extract_theme(theme_pk, using='default', raise_errors=False):
+    """
+    Extracts the files of a pending theme and marks it as ready (or failed,
+    in which case it keeps serving its previous revision, if any).
+    Returns ``False`` if the theme wasn't pending, e.g. because another
+    worker has already claimed it.
+
+    If the theme is re-uploaded while it's being extracted, the outcome of
+    this extraction is dropped, and the theme is left pending so that the
+    new upload gets extracted in turn.
+
+    """
+    # The claim's start time identifies it, so that the outcome is only
+    # recorded if the theme hasn't been re-uploaded (and perhaps claimed
+    # again) in the meantime. Whole seconds survive any database.
+    started = timezone.now().replace(microsecond=0)
+    claimed = Theme.objects.using(using).filter(pk=theme_pk,
+                                                status=Theme.PENDING
+                                       ).update(status=Theme.EXTRACTING,
+                                                extraction_started=started)
+    if not claimed:
+        return False
+
+    theme = Theme.objects.using(using).get(pk=theme_pk)
+    if theme.prune_after is not None and theme.prune_after <= timezone.now():
+        _prune(theme)
+    # Only the status fields are written back; anything else may have been
+    # changed since the theme was loaded.
+    still_claimed = Theme.objects.using(using).filter(
+                                            pk=theme_pk,
+                                            status=Theme.EXTRACTING,
+                                            extraction_started=started)
+    try:
+        theme.update_files()
+    except Exception:
+        logger.exception("Extraction of theme %s failed.", theme_pk)
+        still_claimed.update(status=Theme.FAILED)
+        if raise_errors:
+            raise
+    else:
+        with transaction.commit_on_success(using=using):
+            if still_claimed.update(status=Theme.READY, servable=True):
+                # Made the default while it had nothing to serve; it takes
+                # over now.
+                site_id, default = Theme.objects.using(using).filter(
+                            pk=theme_pk).values_list('site', 'default')[0]
+                if default:
+                    Theme.objects.using(using).exclude(pk=theme_pk).filter(
+                                    site=site_id, default=True
+                                    ).update(default=False)
+        Theme.objects.invalidate(theme.site_id, using)
+    return True
+
+
+def extract_pending_themes(using='default'):
+    """
+    Extracts every pending theme. Returns the number of themes processed.
+
+    Themes which have been extracting for longer than
+    ``UPLOADTEMPLATE_EXTRACTION_TIMEOUT`` seconds are assumed to have been
+    left behind by a worker which died, and are extracted again.
+
+    """
+    timeout = getattr(settings, 'UPLOADTEMPLATE_EXTRACTION_TIMEOUT', 60 * 60)
+    started_before = timezone.now() - timedelta(seconds=timeout)
+    reclaimed = Theme.objects.using(using).filter(
+                    Q(extraction_started__lt=started_before) |
+                    Q(extraction_started__isnull=True),
+                    status=Theme.EXTRACTING).update(status=Theme.PENDING)
+    if reclaimed:
+        logger.warning("Reclaimed %s theme(s) left extracting.", reclaimed)
+
+    count = 0
+    pks = Theme.objects.using(using).filter(status=Theme.PENDING
+                                   ).order_by('pk').values_list('pk', flat=True)
+    for pk in pks:
+        if extract_theme(pk, using):
+            count += 1
+    return count
+
+
+def schedule_pruning(theme):
+    """
+    Removes the files of the theme's old revisions after
+    ``UPLOADTEMPLATE_PRUNE_DELAY`` seconds, giving requests that are still
+    using them time to finish. With a delay of 0, they're removed at once.
+
+    Otherwise they're removed by a timer in this process. In case the
+    process exits first, the theme's ``prune_after`` is set as well, so
+    that :func:`prune_due_themes` or the theme's next extraction removes
+    them instead.
+
+    """
+    delay = getattr(settings, 'UPLOADTEMPLATE_PRUNE_DELAY', 30)
+    if not delay:
+        theme.prune_files()
+        return
+    using = theme._state.db or 'default'
+    theme.prune_after = timezone.now() + timedelta(seconds=delay)
+    Theme.objects.using(using).filter(pk=theme.pk).update(
+                                                prune_after=theme.prune_after)
+    timer = threading.Timer(delay, _prune_in_thread, (theme.pk, using))
+    timer.daemon = True
+    timer.start()
+
+
+def prune_due_themes(using='default'):
+    """
+    Removes the files of old revisions of every theme whose
+    ``prune_after`` has passed. Returns the number of themes pruned.
+
+    """
+    count = 0
+    themes = Theme.objects.using(using).filter(
+                        prune_after__lte=timezone.now()).order_by('pk')
+    for theme in themes:
+        if _prune(theme):
+            count += 1
+    return count
+
+
+def schedule_sweep(root_dir, legacy_dirs=()):
+    """
+    Removes everything under ``root_dir`` in the default storage, and the
+    local ``legacy_dirs``, in a background thread. Used to delete the files
+    of a deleted theme without holding up the request.
+
+    """
+    thread = threading.Thread(target=_sweep, args=(root_dir, legacy_dirs))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(1)
+    return _pool
+
+
+def _extract_in_thread(theme_pk, using):
+    try:
+        # The request which scheduled the extraction may not have committed
+        # the theme's pending status yet, in which case it can't be claimed.
+        for delay in CLAIM_RETRY_DELAYS:
+            time.sleep(delay)
+            if extract_theme(theme_pk, using):
+                return
+            # Start a new transaction, so that the next attempt sees what
+            # has been committed since.
+            connections[using].close()
+        logger.warning("Couldn't claim theme %s for extraction.", theme_pk)
+    finally:
+        # Database connections are per-thread; don't leak this one.
+        connections[using].close()
+
+
+def _prune(theme):
+    try:
+        theme.prune_files()
+    except Exception:
+        logger.exception("Pruning files of theme %s failed.", theme.pk)
+        return False
+    return True
+
+
+def _prune_in_thread(theme_pk, using):
+    try:
+        # Prune against the theme's latest revision, not the one current
+        # when pruning was scheduled.
+        try:
+            theme = Theme.objects.using(using).get(pk=theme_pk)
+        except Theme.DoesNotExist:
+            return
+        theme.prune_files()
+    except Exception:
+        logger.exception("Pruning files of theme %s failed.", theme_pk)
+    finally:
+        connections[using].close()
+
+
+def _sweep(root_dir, legacy_dirs):
+    try:
+        delete_files(iter_files(root_dir))
+        for path in legacy_dirs:
+            remove_local_dir(path)
+    except Exception:
+        logger.exception("Removing files under %s failed.", root_dir)
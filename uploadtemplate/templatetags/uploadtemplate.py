@@ -7,15 +7,82 @@ import warnings
 from django import template
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+from django.test.signals import setting_changed
 
+from uploadtemplate.cache import get_static_manifest, get_zip_reader
 from uploadtemplate.models import Theme
-from uploadtemplate.utils import is_protected_static_file
+from uploadtemplate.signals import theme_files_changed
+from uploadtemplate.utils import is_protected_static_file, serve_from_zip
 
 
 register = template.Library()
 
+# Incremented whenever URLs remembered by StaticNodes may have gone stale.
+_generation = 0
+
+
+def _invalidate_static_nodes(sender, **kwargs):
+    global _generation
+    _generation += 1
+theme_files_changed.connect(_invalidate_static_nodes)
+setting_changed.connect(_invalidate_static_nodes)
+
+
+class StaticNode(template.Node):
+    """
+    Renders the URL of a static file. When the path is a string literal,
+    the URL is remembered on the node until the current theme or its
+    revision changes (or its files or the settings do), so that rendering
+    the node again does no lookups at all.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.literal = _literal_value(path)
+        self._memo = None
+
+    def render(self, context):
+        if self.literal is None:
+            return self.url(context, self.path.resolve(context))
+        key = _memo_key()
+        memo = self._memo
+        if memo is not None and memo[0] == key:
+            return memo[1]
+        url = self.url(context, self.literal)
+        self._memo = (key, url)
+        return url
+
+    def url(self, context, path):
+        return static(context, path)
+
+
+def _literal_value(path):
+    # A FilterExpression without filters whose var isn't a Variable is a
+    # constant, already resolved at parse time.
+    if (isinstance(path, template.FilterExpression) and not path.filters and
+        isinstance(path.var, basestring)):
+        return path.var
+    return None
+
+
+def _memo_key():
+    try:
+        theme = Theme.objects.get_current()
+    except Theme.DoesNotExist:
+        return (_generation, None, None)
+    return (_generation, theme.pk, theme.revision)
+
+
+@register.tag('static')
+def do_static(parser, token):
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(
+                    '{tag_name} takes 1 argument'.format(tag_name=bits[0]))
+    return StaticNode(parser.compile_filter(bits[1]))
+
 
-@register.simple_tag(takes_context=True)
 def static(context, path):
     try:
         theme = Theme.objects.get_current()
@@ -27,14 +94,23 @@ def static(context, path):
         path = path[1:]
 
     if theme is not None and not is_protected_static_file(path):
+        theme_paths, legacy_paths = get_static_manifest(theme)
+
         # Try the new location first.
-        name = os.path.join(theme.theme_files_dir, 'static', path)
-        if default_storage.exists(name):
+        if path in theme_paths and serve_from_zip():
+            # The file's CRC versions the URL, so it can be cached forever.
+            info = get_zip_reader(theme).getinfo('static/' + path)
+            return '{0}?v={1:08x}'.format(
+                reverse('uploadtemplate-static',
+                        kwargs={'theme_id': theme.pk, 'path': path}),
+                info.CRC)
+        if path in theme_paths:
+            name = theme.get_file_name(os.path.join('static', path),
+                                       hashed=True)
             return default_storage.url(name)
 
         # Backwards-compat: Allow old static paths as well.
-        if (hasattr(settings, 'UPLOADTEMPLATE_MEDIA_ROOT') and
-            os.path.exists(os.path.join(theme.static_root(), path))):
+        if path in legacy_paths:
             warnings.warn("Theme {pk} still uses old static paths.".format(pk=theme.pk))
             return urlparse.urljoin(theme.static_url(), path)
 
@@ -4,18 +4,14 @@ import warnings
 
 from django import template
 
-from uploadtemplate.templatetags.uploadtemplate import static
+from uploadtemplate.templatetags.uploadtemplate import static, StaticNode
 
 
 register = template.Library()
 
 
-class GetStaticUrlNode(template.Node):
-    def __init__(self, path):
-        self.path = path
-
-    def render(self, context):
-        path = self.path.resolve(context)
+class GetStaticUrlNode(StaticNode):
+    def url(self, context, path):
         return static(context, path)
 
 
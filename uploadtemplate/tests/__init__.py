@@ -5,6 +5,7 @@ from django.core.files import File
 from django.test import TestCase
 
 import uploadtemplate
+from uploadtemplate import cache
 from uploadtemplate.models import Theme
 
 
@@ -13,6 +14,7 @@ class BaseTestCase(TestCase):
 
     def setUp(self):
         Theme.objects.clear_cache()
+        cache.clear()
         super(BaseTestCase, self).setUp()
 
     def _data_file_path(self, data_file):
@@ -0,0 +1,38 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from uploadtemplate.benchmark import (benchmark_theme, FlatLatencyStorage,
+                                      LatencyStorage)
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.utils import iter_files
+
+
+class LatencyStorageTestCase(BaseTestCase):
+    def test_counts_calls(self):
+        storage = LatencyStorage()
+        storage.save('a/b/c.txt', ContentFile('c'))
+        self.assertTrue(storage.exists('a/b'))
+        self.assertEqual(storage.listdir('a'), (['b'], []))
+        storage.delete('a/b/c.txt')
+        self.assertFalse(storage.exists('a'))
+        self.assertEqual(storage.calls, {'exists': 3, 'save': 1,
+                                         'listdir': 1, 'delete': 1})
+
+    def test_flat(self):
+        storage = FlatLatencyStorage()
+        storage.save('a/b/c.txt', ContentFile('c'))
+        storage.reset_calls()
+        self.assertEqual(list(iter_files('a/', storage)), ['a/b/c.txt'])
+        self.assertEqual(storage.calls, {'list_prefix': 1})
+
+
+class BenchmarkTestCase(BaseTestCase):
+    def test_benchmark_theme(self):
+        wrapped = default_storage._wrapped
+        results = benchmark_theme(20, 2, LatencyStorage())
+        self.assertTrue(default_storage._wrapped is wrapped)
+        results = dict((result.name, result) for result in results)
+        self.assertTrue(results['extract'].calls > 0)
+        self.assertEqual(results['extract (unchanged)'].calls, 0)
+        self.assertEqual(results['template miss'].ops, 2)
+        self.assertEqual(results['template miss'].calls, 0)
@@ -0,0 +1,65 @@
+from django.utils import unittest
+import mock
+
+from uploadtemplate import cache
+from uploadtemplate.cache import LRUCache
+from uploadtemplate.tests import BaseTestCase
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache(10)
+        self.assertTrue(cache.get('a') is None)
+        cache.set('a', 'aaa')
+        self.assertEqual(cache.get('a'), 'aaa')
+        self.assertEqual(cache.size, 3)
+        cache.set('a', 'a')
+        self.assertEqual(cache.size, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.get('a')
+        cache.set('c', 'cccc')
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertEqual(cache.size, 8)
+
+    def test_too_large(self):
+        cache = LRUCache(10)
+        cache.set('a', 'a' * 11)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_delete_matching(self):
+        cache = LRUCache(100)
+        cache.set((1, 'a'), 'a')
+        cache.set((1, 'b'), 'b')
+        cache.set((2, 'a'), 'a')
+        cache.delete_matching(lambda key: key[0] == 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 1)
+        self.assertTrue((2, 'a') in cache)
+
+
+class GetThemeFilesTestCase(BaseTestCase):
+    def test_one_listing_per_revision(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.save_files()
+        theme.manifest = ''
+        with mock.patch('uploadtemplate.cache.iter_files',
+                        wraps=cache.iter_files) as list_files:
+            self.assertEqual(cache.get_theme_files(theme),
+                             set(['static/logo.png',
+                                  'templates/uploadtemplate/index.html']))
+            cache.get_static_manifest(theme)
+            cache.get_template_manifest(theme)
+            self.assertEqual(list_files.call_count, 1)
+
+            theme.revision += 1
+            cache.get_theme_files(theme)
+            self.assertEqual(list_files.call_count, 2)
+        theme.revision -= 1
+        theme.delete_files()
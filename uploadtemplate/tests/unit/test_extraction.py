@@ -0,0 +1,252 @@
+import gzip
+import os
+import posixpath
+import re
+from StringIO import StringIO
+import zipfile
+
+from django.core.files.storage import default_storage
+from django.test.utils import override_settings
+import mock
+
+from uploadtemplate.extraction import (extract_files, ThemeExtractionError,
+                                       ThemeSizeError, _compress, _copy,
+                                       hashed_name, rewrite_css,
+                                       write_compressed_files,
+                                       write_hashed_files)
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.utils import get_zip_manifest
+
+
+class ExtractFilesTestCase(BaseTestCase):
+    file_list = ['static/logo.png', 'templates/uploadtemplate/index.html']
+
+    def setUp(self):
+        super(ExtractFilesTestCase, self).setUp()
+        self.data_file = self._data_file('zips/theme.zip')
+        self.zip_file = zipfile.ZipFile(self.data_file)
+        self.target_dir = 'uploadtemplate/test_extraction/'
+
+    def tearDown(self):
+        self.zip_file.close()
+        self.data_file.close()
+        for name in self.file_list:
+            name = os.path.join(self.target_dir, name)
+            if default_storage.exists(name):
+                default_storage.delete(name)
+        super(ExtractFilesTestCase, self).tearDown()
+
+    def test_extract_files__parallel(self):
+        extract_files(self.zip_file, self.file_list, self.target_dir,
+                      workers=4)
+        for name in self.file_list:
+            fp = default_storage.open(os.path.join(self.target_dir, name))
+            self.assertEqual(fp.read(), self.zip_file.read(name))
+            fp.close()
+
+    def test_extract_files__errors(self):
+        def save(name, content):
+            if name.endswith('.png'):
+                raise IOError('Broken')
+        with mock.patch('uploadtemplate.extraction.default_storage') as storage:
+            storage.exists.return_value = False
+            storage.save.side_effect = save
+            try:
+                extract_files(self.zip_file, self.file_list, self.target_dir,
+                              workers=2)
+            except ThemeExtractionError, e:
+                self.assertEqual([filename for filename, exc in e.errors],
+                                 ['static/logo.png'])
+                self.assertTrue(isinstance(e.errors[0][1], IOError))
+            else:
+                self.fail('ThemeExtractionError not raised')
+            self.assertEqual(storage.save.call_count, 2)
+
+    def test_extract_files__max_file_size(self):
+        size = self.zip_file.getinfo('static/logo.png').file_size
+        with override_settings(UPLOADTEMPLATE_MAX_FILE_SIZE=size - 1):
+            try:
+                extract_files(self.zip_file, self.file_list, self.target_dir)
+            except ThemeExtractionError, e:
+                self.assertEqual([filename for filename, exc in e.errors],
+                                 ['static/logo.png'])
+                self.assertTrue(isinstance(e.errors[0][1], ThemeSizeError))
+            else:
+                self.fail('ThemeExtractionError not raised')
+        self.assertFalse(default_storage.exists(
+                        os.path.join(self.target_dir, 'static/logo.png')))
+
+    def test_extract_files__max_total_size(self):
+        with override_settings(UPLOADTEMPLATE_MAX_TOTAL_SIZE=1):
+            self.assertRaises(ThemeSizeError, extract_files, self.zip_file,
+                              self.file_list, self.target_dir)
+
+    def test_copy__limits(self):
+        # Sizes recorded in the zip file can lie, so the bytes actually read
+        # are checked as well.
+        dest = StringIO()
+        self.assertEqual(_copy(StringIO('x' * 10), dest, 'name', 10, [0], 10),
+                         10)
+        self.assertEqual(dest.getvalue(), 'x' * 10)
+        self.assertRaises(ThemeSizeError, _copy, StringIO('x' * 11),
+                          StringIO(), 'name', 10, [0], None)
+        self.assertRaises(ThemeSizeError, _copy, StringIO('x' * 5),
+                          StringIO(), 'name', None, [6], 10)
+
+    def test_compress__limits(self):
+        size, compressed = _compress(StringIO('x' * 10), ['gzip'], 'name', 10)
+        self.assertEqual(size, 10)
+        fp = compressed['gzip']
+        fp.seek(0)
+        self.assertEqual(gzip.GzipFile(fileobj=fp, mode='rb').read(), 'x' * 10)
+        fp.close()
+        self.assertRaises(ThemeSizeError, _compress, StringIO('x' * 11),
+                          ['gzip'], 'name', 10)
+
+
+class HashedFilesTestCase(BaseTestCase):
+    root_dir = 'uploadtemplate/test_hashed/'
+    files = {
+        'static/css/site.css': ('@import "other.css";\n'
+                                'a { background: url("../img/logo.png?x#y"); }\n'
+                                'b { background: url(data:image/png;base64,); }\n'
+                                'i { background: url(/absolute.png); }\n'),
+        'static/css/other.css': 'p { background: url(../img/logo.png); }\n',
+        'static/img/logo.png': 'PNG',
+        'templates/index.html': 'Index',
+    }
+
+    def setUp(self):
+        super(HashedFilesTestCase, self).setUp()
+        fp = StringIO()
+        zip_file = zipfile.ZipFile(fp, 'w')
+        for name, content in self.files.iteritems():
+            zip_file.writestr(name, content)
+        zip_file.close()
+        self.zip_file = zipfile.ZipFile(fp)
+
+    def tearDown(self):
+        for dir_path, dirs, files in os.walk(default_storage.path(
+                                                            self.root_dir)):
+            for filename in files:
+                os.remove(os.path.join(dir_path, filename))
+        super(HashedFilesTestCase, self).tearDown()
+
+    def _read(self, path):
+        fp = default_storage.open(self.root_dir + path)
+        try:
+            return fp.read()
+        finally:
+            fp.close()
+
+    def test_hashed_name(self):
+        self.assertEqual(hashed_name('static/css/site.css', '0123456789abcdef'),
+                         'static/css/site.0123456789ab.css')
+        self.assertEqual(hashed_name('static/LICENSE', '0123456789abcdef'),
+                         'static/LICENSE.0123456789ab')
+
+    def test_rewrite_css(self):
+        resolve = {'static/img/logo.png': '2/static/img/logo.abc.png'}.get
+        self.assertEqual(
+            rewrite_css("url('../img/logo.png#top') url(logo.png) "
+                        "url(http://example.com/img/logo.png)",
+                        'static/css/site.css', resolve),
+            "url('../../../2/static/img/logo.abc.png#top') url(logo.png) "
+            "url(http://example.com/img/logo.png)")
+
+    def test_write_hashed_files(self):
+        manifest = get_zip_manifest(self.zip_file)
+        write_hashed_files(self.zip_file, manifest, {}, list(manifest),
+                           self.root_dir, 1)
+        self.assertFalse('hashed_path' in manifest['templates/index.html'])
+        logo = manifest['static/img/logo.png']['hashed_path']
+        other = manifest['static/css/other.css']['hashed_path']
+        site = manifest['static/css/site.css']['hashed_path']
+        self.assertTrue(logo.startswith('1/static/img/logo.'))
+        self.assertEqual(self._read(logo), 'PNG')
+        self.assertEqual(self._read(other),
+                         'p {{ background: url(../../../{0}); }}\n'.format(
+                                                                    logo))
+        content = self._read(site)
+        self.assertTrue('@import "../../../{0}";'.format(other) in content)
+        self.assertTrue('url("../../../{0}?x#y")'.format(logo) in content)
+        self.assertTrue('url(data:image/png;base64,)' in content)
+        self.assertTrue('url(/absolute.png)' in content)
+
+        # Files which haven't changed keep their hashed copies.
+        new_manifest = get_zip_manifest(self.zip_file)
+        with mock.patch('uploadtemplate.extraction.default_storage') as storage:
+            write_hashed_files(self.zip_file, new_manifest, manifest, [],
+                               self.root_dir, 2)
+            self.assertFalse(storage.save.called)
+        self.assertEqual(new_manifest, manifest)
+
+    def test_write_hashed_files__changed_css(self):
+        manifest = get_zip_manifest(self.zip_file)
+        write_hashed_files(self.zip_file, manifest, {}, list(manifest),
+                           self.root_dir, 1)
+        # Only the CSS changes in the next revision; the image keeps its
+        # hashed copy from the first.
+        fp = StringIO()
+        zip_file = zipfile.ZipFile(fp, 'w')
+        for name, content in self.files.iteritems():
+            if name == 'static/css/other.css':
+                content += '\n'
+            zip_file.writestr(name, content)
+        zip_file.close()
+        zip_file = zipfile.ZipFile(fp)
+        new_manifest = get_zip_manifest(zip_file)
+        write_hashed_files(zip_file, new_manifest, manifest,
+                           ['static/css/other.css'], self.root_dir, 2)
+        other = new_manifest['static/css/other.css']['hashed_path']
+        logo = new_manifest['static/img/logo.png']['hashed_path']
+        self.assertTrue(other.startswith('2/'))
+        self.assertTrue(logo.startswith('1/'))
+        url = re.search(r'url\((.*)\)', self._read(other)).group(1)
+        self.assertEqual(posixpath.normpath(posixpath.join(
+                                    posixpath.dirname(other), url)), logo)
+        self.assertEqual(self._read(logo), 'PNG')
+
+    def test_write_compressed_files(self):
+        manifest = get_zip_manifest(self.zip_file)
+        write_hashed_files(self.zip_file, manifest, {}, list(manifest),
+                           self.root_dir, 1)
+        with mock.patch('uploadtemplate.extraction.brotli', None):
+            write_compressed_files(self.zip_file, manifest, {},
+                                   self.root_dir, min_size=0)
+        site = manifest['static/css/site.css']
+        self.assertEqual(site['encodings'],
+                         {'gzip': site['hashed_path'] + '.gz'})
+        fp = gzip.GzipFile(fileobj=StringIO(
+                                    self._read(site['encodings']['gzip'])))
+        self.assertEqual(fp.read(), self._read(site['hashed_path']))
+        # Too small to benefit.
+        self.assertEqual(manifest['static/css/other.css']['encodings'], {})
+        # Not compressible, or not static.
+        self.assertFalse('encodings' in manifest['static/img/logo.png'])
+        self.assertFalse('encodings' in manifest['templates/index.html'])
+
+        # Unchanged files keep their compressed copies.
+        new_manifest = get_zip_manifest(self.zip_file)
+        write_hashed_files(self.zip_file, new_manifest, manifest, [],
+                           self.root_dir, 2)
+        with mock.patch('uploadtemplate.extraction.default_storage') as storage:
+            write_compressed_files(self.zip_file, new_manifest, manifest,
+                                   self.root_dir, min_size=0)
+            self.assertFalse(storage.save.called)
+        self.assertEqual(new_manifest, manifest)
+
+    def test_write_compressed_files__brotli(self):
+        manifest = get_zip_manifest(self.zip_file)
+        extract_files(self.zip_file, list(manifest), self.root_dir)
+        with mock.patch('uploadtemplate.extraction.brotli') as brotli:
+            compressor = brotli.Compressor.return_value
+            compressor.process.return_value = 'b'
+            compressor.finish.return_value = 'r'
+            write_compressed_files(self.zip_file, manifest, {},
+                                   self.root_dir, min_size=100)
+        self.assertEqual(manifest['static/css/site.css']['encodings'],
+                         {'gzip': 'static/css/site.css.gz',
+                          'br': 'static/css/site.css.br'})
+        self.assertEqual(self._read('static/css/site.css.br'), 'br')
+        self.assertFalse('encodings' in manifest['static/css/other.css'])
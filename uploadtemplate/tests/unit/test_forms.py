@@ -1,6 +1,8 @@
 import zipfile
 
 from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.test.utils import override_settings
 import mock
 
 from uploadtemplate.forms import ThemeForm
@@ -83,16 +85,69 @@ class ThemeFormTestCase(BaseTestCase):
         self.assertEqual(form.clean_theme_files_zip(), data_file)
         data_file.close()
 
+    def _assert_zip_invalid(self, message, **settings):
+        form = ThemeForm()
+        data_file = self._data_file('zips/theme.zip')
+        form.cleaned_data = {'theme_files_zip': data_file}
+        with override_settings(**settings):
+            self.assertRaisesMessage(ValidationError, message,
+                                     form.clean_theme_files_zip)
+        data_file.close()
+
+    def test_clean_zip__too_many_files(self):
+        self._assert_zip_invalid('Zip archive contains too many files.',
+                                 UPLOADTEMPLATE_MAX_FILE_COUNT=4)
+
+    def test_clean_zip__file_too_large(self):
+        self._assert_zip_invalid('Zip archive contains files which are too '
+                                 'large.',
+                                 UPLOADTEMPLATE_MAX_FILE_SIZE=1000)
+
+    def test_clean_zip__total_too_large(self):
+        self._assert_zip_invalid('Zip archive is too large when '
+                                 'uncompressed.',
+                                 UPLOADTEMPLATE_MAX_TOTAL_SIZE=1250)
+
+    def test_clean_zip__compression_ratio(self):
+        self._assert_zip_invalid('Zip archive contains files which are too '
+                                 'highly compressed.',
+                                 UPLOADTEMPLATE_MAX_COMPRESSION_RATIO=0.5)
+
     def test_save(self):
         data_file = self._data_file('zips/theme.zip')
         with mock.patch.object(Theme, 'save_files') as save_files:
             with mock.patch.object(Theme, 'prune_files') as prune_files:
-                form = ThemeForm({'name': 'Theme',
-                                  'theme_files_zip': data_file})
+                form = ThemeForm({'name': 'Theme'},
+                                 {'theme_files_zip': File(data_file)})
                 self.assertTrue(form.is_valid())
                 self.assertTrue(form.instance.site_id is None)
                 form.save()
                 save_files.assert_called_once_with()
                 prune_files.assert_called_once_with()
                 self.assertFalse(form.instance.site_id is None)
+                self.assertEqual(form.instance.status, Theme.READY)
+        data_file.close()
+
+    def test_save__no_new_zip(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        with mock.patch.object(Theme, 'save_files') as save_files:
+            form = ThemeForm({'name': 'Renamed'}, instance=theme)
+            self.assertTrue(form.is_valid())
+            form.save()
+            self.assertFalse(save_files.called)
+
+    def test_save__manifest(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.manifest = '{}'
+        theme.save()
+        data_file = self._data_file('zips/theme.zip')
+        with mock.patch.object(Theme, 'save_files') as save_files:
+            with mock.patch.object(Theme, 'prune_files') as prune_files:
+                form = ThemeForm({'name': 'Theme'},
+                                 {'theme_files_zip': File(data_file)},
+                                 instance=theme)
+                self.assertTrue(form.is_valid())
+                form.save()
+                save_files.assert_called_once_with()
+                self.assertFalse(prune_files.called)
         data_file.close()
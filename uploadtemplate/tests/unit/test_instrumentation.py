@@ -0,0 +1,87 @@
+from django.core.files.storage import default_storage
+from django.http import HttpResponse
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+import mock
+
+from uploadtemplate import cache
+from uploadtemplate.instrumentation import (collect, InstrumentationMiddleware,
+                                            InstrumentedStorage, record,
+                                            StorageCallsTestMixin, timed,
+                                            uninstrument_storage)
+from uploadtemplate.loader import Loader
+from uploadtemplate.models import Theme
+from uploadtemplate.signals import operation_timed
+from uploadtemplate.tests import BaseTestCase
+
+
+class InstrumentationTestCase(StorageCallsTestMixin, BaseTestCase):
+    def tearDown(self):
+        uninstrument_storage()
+        super(InstrumentationTestCase, self).tearDown()
+
+    def test_theme_lookup(self):
+        self.create_theme(default=True)
+        Theme.objects.clear_cache()
+        with collect() as collector:
+            Theme.objects.get_current()
+            Theme.objects.get_current()
+        self.assertEqual(collector.counts, {'theme_lookup': 1})
+
+    def test_assert_num_storage_calls(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        cache.clear()
+        loader = Loader()
+        with self.assertNumStorageCalls(1) as collector:
+            loader.load_template_source('uploadtemplate/index.html')
+        self.assertEqual(collector.counts['storage.open'], 1)
+        self.assertEqual(collector.counts['template_read'], 1)
+        self.assertNumStorageCalls(0, loader.load_template_source,
+                                   'uploadtemplate/index.html')
+        self.assertFalse(isinstance(default_storage._wrapped,
+                                    InstrumentedStorage))
+        with self.assertRaises(AssertionError):
+            with self.assertNumStorageCalls(0):
+                default_storage.exists('missing')
+        theme.delete_files()
+
+    def test_signal(self):
+        calls = []
+        def receiver(sender, **kwargs):
+            calls.append(kwargs)
+        operation_timed.connect(receiver)
+        try:
+            with timed('operation', key='value'):
+                pass
+        finally:
+            operation_timed.disconnect(receiver)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]['operation'], 'operation')
+        self.assertEqual(calls[0]['details'], {'key': 'value'})
+
+    def test_slow_operations_logged(self):
+        with mock.patch('uploadtemplate.instrumentation.logger') as logger:
+            record('fast', 0.5)
+            self.assertFalse(logger.warning.called)
+            with override_settings(UPLOADTEMPLATE_SLOW_LOOKUP_THRESHOLD=1):
+                record('fast', 0.5)
+                record('slow', 2, key='value')
+            self.assertEqual(logger.warning.call_count, 1)
+            self.assertEqual(logger.warning.call_args[1]['extra'],
+                             {'operation': 'slow', 'duration': 2,
+                              'details': {'key': 'value'}})
+
+    def test_middleware(self):
+        middleware = InstrumentationMiddleware()
+        self.assertTrue(isinstance(default_storage._wrapped,
+                                   InstrumentedStorage))
+        request = RequestFactory().get('/')
+        middleware.process_request(request)
+        default_storage.exists('missing')
+        response = HttpResponse()
+        self.assertTrue(middleware.process_response(request, response)
+                        is response)
+        default_storage.exists('missing')
+        self.assertEqual(request.uploadtemplate_operations.counts,
+                         {'storage.exists': 1})
@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.template import TemplateDoesNotExist
+from django.template.loaders import filesystem
+from django.test.utils import override_settings
+import mock
+
+from uploadtemplate.cache import template_source_cache
+from uploadtemplate.loader import Loader, CachedLoader
+from uploadtemplate.tests import BaseTestCase
+
+
+@override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/')
+class LoaderTestCase(BaseTestCase):
+    def setUp(self):
+        super(LoaderTestCase, self).setUp()
+        self.loader = Loader()
+
+    def test_source_is_cached(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        source, name = self.loader.load_template_source(
+                                                'uploadtemplate/index.html')
+        self.assertEqual(name, os.path.join(theme.theme_files_dir,
+                                            'templates/uploadtemplate/index.html'))
+        with mock.patch('uploadtemplate.loader.default_storage') as storage:
+            self.assertEqual(self.loader.load_template_source(
+                                                'uploadtemplate/index.html'),
+                             (source, name))
+            self.assertFalse(storage.exists.called)
+            self.assertFalse(storage.open.called)
+        theme.delete_files()
+
+    def test_manifest(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        with mock.patch('uploadtemplate.loader.default_storage') as storage:
+            storage.open.return_value = ContentFile('source')
+            self.loader.load_template_source('uploadtemplate/index.html')
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+            self.assertFalse(storage.exists.called)
+        theme.delete_files()
+
+    @override_settings(UPLOADTEMPLATE_SERVE_FROM_ZIP=True)
+    def test_serve_from_zip(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.delete_files()
+        with mock.patch('uploadtemplate.loader.default_storage') as storage:
+            source, name = self.loader.load_template_source(
+                                                'uploadtemplate/index.html')
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+            self.assertFalse(storage.method_calls)
+        self.assertEqual(name, theme.theme_files_zip.name +
+                         ':templates/uploadtemplate/index.html')
+        zip_file = zipfile.ZipFile(theme.theme_files_zip)
+        self.assertEqual(source,
+                         zip_file.read('templates/uploadtemplate/index.html'))
+        zip_file.close()
+
+    def test_miss_is_cached(self):
+        self.create_theme(default=True)
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        with mock.patch('uploadtemplate.loader.default_storage') as storage:
+            self.assertRaises(TemplateDoesNotExist,
+                              self.loader.load_template_source, 'missing.html')
+            self.assertFalse(storage.exists.called)
+
+    def test_invalidated_by_file_changes(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        template_name = 'uploadtemplate/index.html'
+        source, name = self.loader.load_template_source(template_name)
+        theme.delete_files()
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, template_name)
+        theme.save_files()
+        self.assertEqual(self.loader.load_template_source(template_name),
+                         (source, theme.get_file_name(
+                                    'templates/uploadtemplate/index.html')))
+        theme.delete_files()
+
+    def test_not_provided(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        self.assertRaises(TemplateDoesNotExist,
+                          self.loader.load_template_source, 'missing.html')
+        with mock.patch('uploadtemplate.loader.default_storage') as storage:
+            with mock.patch.object(filesystem.Loader,
+                                   'load_template_source') as legacy:
+                self.assertRaises(TemplateDoesNotExist,
+                                  self.loader.load_template_source,
+                                  'missing.html')
+                self.assertFalse(legacy.called)
+            self.assertFalse(storage.method_calls)
+        self.assertFalse((theme.pk, theme.revision, 'missing.html')
+                         in template_source_cache)
+        theme.delete_files()
+
+    def test_legacy_template(self):
+        theme = self.create_theme(default=True)
+        template_dir = theme.template_dir()
+        os.makedirs(os.path.join(template_dir, 'legacy'))
+        try:
+            with open(os.path.join(template_dir, 'legacy/index.html'),
+                      'w') as fp:
+                fp.write('Legacy')
+            source, name = self.loader.load_template_source(
+                                                    'legacy/index.html')
+            self.assertEqual(source, 'Legacy')
+        finally:
+            shutil.rmtree(template_dir)
+
+
+@override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/')
+class CachedLoaderTestCase(BaseTestCase):
+    def setUp(self):
+        super(CachedLoaderTestCase, self).setUp()
+        self.loader = CachedLoader()
+
+    def test_compiled_template_is_cached(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        template, origin = self.loader.load_template(
+                                                'uploadtemplate/index.html')
+        self.assertTrue(origin is None)
+        self.assertTrue(hasattr(template, 'render'))
+        with mock.patch.object(Loader, 'load_template_source') as load:
+            self.assertTrue(self.loader.load_template(
+                                    'uploadtemplate/index.html')[0] is template)
+            self.assertFalse(load.called)
+        theme.delete_files()
+
+    def test_evicted_when_files_replaced(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        template = self.loader.load_template('uploadtemplate/index.html')[0]
+        # Forget the manifest so that every file is replaced.
+        theme.manifest = ''
+        theme.save_files()
+        self.assertFalse(self.loader.load_template(
+                                'uploadtemplate/index.html')[0] is template)
+        theme.delete_files()
@@ -1,11 +1,21 @@
+import json
 import os
+import posixpath
+from StringIO import StringIO
+import tempfile
 import zipfile
 
+from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.core.signals import request_finished
 from django.core.files.storage import default_storage
+from django.test.utils import override_settings
+import mock
 
 from uploadtemplate.models import Theme
+from uploadtemplate.tasks import schedule_sweep
 from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.utils import iter_files
 
 
 class ThemeTestCase(BaseTestCase):
@@ -40,16 +50,218 @@ class ThemeTestCase(BaseTestCase):
         theme.delete_files()
         self.assertEqual(theme.list_files(), [])
 
+    def test_save_files__manifest(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        self.assertTrue(theme.get_manifest() is None)
+        theme.save_files()
+        manifest = Theme.objects.get(pk=theme.pk).get_manifest()
+        self.assertEqual(set(manifest),
+                         set(['static/logo.png',
+                              'templates/uploadtemplate/index.html']))
+        zip_file = zipfile.ZipFile(theme.theme_files_zip, 'r')
+        info = zip_file.getinfo('static/logo.png')
+        zip_file.close()
+        self.assertEqual(manifest['static/logo.png'],
+                         {'size': info.file_size,
+                          'crc': info.CRC,
+                          'content_type': 'image/png',
+                          'path': '1/static/logo.png'})
+        theme.delete_files()
+        self.assertTrue(theme.get_manifest() is None)
+
+    def test_save_files__incremental(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.delete_files()
+        theme.save_files()
+        with mock.patch('uploadtemplate.extraction.default_storage') as storage:
+            theme.save_files()
+            self.assertFalse(storage.save.called)
+
+        # Pretend that one file has changed and another has been removed.
+        manifest = theme.get_manifest()
+        old_name = theme.get_file_name('static/logo.png')
+        manifest['static/logo.png']['crc'] += 1
+        manifest['static/removed.png'] = manifest['static/logo.png']
+        theme.manifest = json.dumps(manifest)
+        deleted = []
+        def delete_files(names):
+            deleted.extend(names)
+            return len(deleted)
+        with mock.patch('uploadtemplate.extraction.default_storage') as storage:
+            with mock.patch('uploadtemplate.models.delete_files',
+                            side_effect=delete_files):
+                theme.save_files()
+            self.assertEqual(theme.revision, 2)
+            self.assertEqual(storage.save.call_count, 1)
+            self.assertEqual(storage.save.call_args[0][0],
+                             os.path.join(theme.theme_files_dir,
+                                          'static/logo.png'))
+            # The old copy is pruned once the theme has moved on.
+            self.assertEqual(deleted, [old_name])
+        self.assertFalse('static/removed.png' in theme.get_manifest())
+        self.assertEqual(theme.get_file_name('static/logo.png'),
+                         os.path.join(theme.theme_root_dir,
+                                      '2/static/logo.png'))
+        self.assertEqual(theme.get_file_name(
+                                'templates/uploadtemplate/index.html'),
+                         os.path.join(theme.theme_root_dir,
+                                      '1/templates/uploadtemplate/index.html'))
+        theme.delete_files()
+
+    def _save_zip(self, theme, files):
+        fp = StringIO()
+        zip_file = zipfile.ZipFile(fp, 'w')
+        for name, content in files.iteritems():
+            zip_file.writestr(name, content)
+        zip_file.close()
+        theme.theme_files_zip.save('theme.zip', ContentFile(fp.getvalue()))
+
+    def test_save_files__relative_references(self):
+        theme = self.create_theme()
+        files = {'static/css/site.css': 'a { background: url(../img/a.png); }',
+                 'static/img/a.png': 'PNG',
+                 'templates/index.html': 'Index'}
+        self._save_zip(theme, files)
+        theme.save_files()
+        # Re-upload with only the CSS changed.
+        files['static/css/site.css'] += '\n'
+        self._save_zip(theme, files)
+        theme.save_files()
+        self.assertEqual(theme.revision, 2)
+
+        css_name = theme.get_file_name('static/css/site.css')
+        image_name = posixpath.normpath(posixpath.join(
+                            posixpath.dirname(css_name), '../img/a.png'))
+        self.assertEqual(image_name, theme.get_file_name('static/img/a.png'))
+        self.assertTrue(default_storage.exists(image_name))
+        # Unchanged templates aren't copied.
+        self.assertEqual(theme.get_file_name('templates/index.html'),
+                         theme.theme_root_dir + '1/templates/index.html')
+        theme.delete_files()
+
+    def test_save_files__revisions(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.save_files()
+        self.assertEqual(theme.revision, 1)
+        self.assertEqual(Theme.objects.get(pk=theme.pk).revision, 1)
+        old_files = theme.list_files()
+        theme.manifest = ''
+        theme.save_files()
+        self.assertEqual(theme.revision, 2)
+        self.assertEqual(theme.theme_files_dir,
+                         os.path.join(theme.theme_root_dir, '2/'))
+        new_files = theme.list_files()
+        self.assertEqual(len(new_files), 2)
+        self.assertFalse(set(old_files) & set(new_files))
+        theme.delete_files()
+
+    @override_settings(UPLOADTEMPLATE_PRUNE_DELAY=30)
+    def test_update_files__pruning_deferred(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        self.assertTrue(theme.get_manifest() is None)
+        with mock.patch('uploadtemplate.tasks.threading.Timer') as timer:
+            with mock.patch.object(Theme, 'prune_files') as prune_files:
+                theme.update_files()
+                # Requests may still be using the old files.
+                self.assertFalse(prune_files.called)
+            self.assertTrue(timer.called)
+        self.assertFalse(Theme.objects.get(pk=theme.pk).prune_after is None)
+        theme.prune_files()
+        self.assertFalse(Theme.objects.get(pk=theme.pk).prune_after is None)
+        theme.delete_files()
+
     def test_prune_files(self):
         theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.delete_files()
+        theme.save_files()
         file_list = ['static/logo.png', 'templates/uploadtemplate/index.html']
         file_list = [os.path.join(theme.theme_files_dir, name)
                      for name in file_list]
-        theme.delete_files()
-        theme.save_files()
         self.assertEqual(set(theme.list_files()), set(file_list))
         new_file = os.path.join(theme.theme_files_dir, 'static/other.png')
         default_storage.save(new_file, ContentFile(''))
         self.assertEqual(set(theme.list_files()), set(file_list + [new_file]))
         theme.prune_files()
         self.assertEqual(set(theme.list_files()), set(file_list))
+
+
+class ThemeManagerTestCase(BaseTestCase):
+    def test_cache_survives_request(self):
+        theme = self.create_theme(default=True)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        request_finished.send(sender=self.__class__)
+        with self.assertNumQueries(0):
+            self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_cache_expires(self):
+        theme = self.create_theme(default=True)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        Theme.objects.filter(pk=theme.pk).update(default=False)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        with mock.patch('uploadtemplate.models.time.time') as time:
+            time.return_value = 10 ** 10
+            self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
+
+    @override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/')
+    def test_delete_clears_cache(self):
+        theme = self.create_theme(default=True)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        theme.delete()
+        self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
+
+    @override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/',
+                       UPLOADTEMPLATE_DEFER_FILE_DELETION=True)
+    def test_delete__deferred(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        theme.save_files()
+        root_dir = theme.theme_root_dir
+        legacy_dirs = [theme.static_root(), theme.template_dir()]
+        with mock.patch('uploadtemplate.tasks.schedule_sweep') as sweep:
+            theme.delete()
+            sweep.assert_called_once_with(root_dir, legacy_dirs)
+        self.assertFalse(Theme.objects.filter(name='Theme').exists())
+        self.assertNotEqual(list(iter_files(root_dir)), [])
+        schedule_sweep(root_dir, legacy_dirs).join()
+        self.assertEqual(list(iter_files(root_dir)), [])
+
+
+@override_settings(UPLOADTEMPLATE_THEME_CACHE='default')
+class SharedThemeCacheTestCase(BaseTestCase):
+    def setUp(self):
+        super(SharedThemeCacheTestCase, self).setUp()
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+        super(SharedThemeCacheTestCase, self).tearDown()
+
+    def test_get_current__shared(self):
+        theme = self.create_theme(default=True)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        Theme.objects.clear_cache()
+        with self.assertNumQueries(0):
+            self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_get_current__no_theme(self):
+        self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
+        Theme.objects.clear_cache()
+        with self.assertNumQueries(0):
+            self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
+
+    def test_save_bumps_version(self):
+        theme = self.create_theme(default=True)
+        Theme.objects.get_current()
+        theme2 = self.create_theme(default=False)
+        Theme.objects.filter(pk=theme.pk).update(default=False)
+        theme2.default = True
+        theme2.save()
+        Theme.objects.clear_cache()
+        self.assertEqual(Theme.objects.get_current(), theme2)
+
+    def test_invalidate(self):
+        theme = self.create_theme(default=True)
+        Theme.objects.get_current()
+        Theme.objects.filter(pk=theme.pk).update(default=False)
+        Theme.objects.invalidate(theme.site_id)
+        Theme.objects.clear_cache()
+        self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
@@ -0,0 +1,185 @@
+from datetime import timedelta
+
+from django.core.files import File
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils import timezone
+import mock
+
+from uploadtemplate.forms import ThemeForm
+from uploadtemplate.models import Theme
+from uploadtemplate.tasks import (extract_pending_themes, extract_theme,
+                                  prune_due_themes, _extract_in_thread)
+from uploadtemplate.tests import BaseTestCase
+
+
+@override_settings(UPLOADTEMPLATE_EXTRACTION='queue')
+class QueuedExtractionTestCase(BaseTestCase):
+    def _upload(self, instance=None, **data):
+        data.setdefault('name', 'Theme')
+        data_file = self._data_file('zips/theme.zip')
+        form = ThemeForm(data, {'theme_files_zip': File(data_file)},
+                         instance=instance)
+        self.assertTrue(form.is_valid())
+        theme = form.save()
+        data_file.close()
+        return theme
+
+    def test_save__pending(self):
+        old = self.create_theme(default=True)
+        with mock.patch.object(Theme, 'save_files') as save_files:
+            theme = self._upload(default=True)
+            self.assertFalse(save_files.called)
+        self.assertEqual(Theme.objects.get(pk=theme.pk).status, Theme.PENDING)
+        self.assertEqual(Theme.objects.get_current(), old)
+        Theme.objects.clear_cache()
+        self.assertEqual(Theme.objects.get_current(), old)
+
+    def test_extract_theme(self):
+        old = self.create_theme(default=True)
+        theme = self._upload(default=True)
+        with mock.patch.object(Theme, 'update_files') as update_files:
+            self.assertTrue(extract_theme(theme.pk))
+            update_files.assert_called_once_with()
+            # Already extracted.
+            self.assertFalse(extract_theme(theme.pk))
+        theme = Theme.objects.get(pk=theme.pk)
+        self.assertEqual(theme.status, Theme.READY)
+        self.assertTrue(theme.default)
+        self.assertFalse(Theme.objects.get(pk=old.pk).default)
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_extract_theme__failed(self):
+        theme = self._upload(default=True)
+        with mock.patch.object(Theme, 'update_files') as update_files:
+            update_files.side_effect = IOError
+            self.assertTrue(extract_theme(theme.pk))
+        self.assertEqual(Theme.objects.get(pk=theme.pk).status, Theme.FAILED)
+        self.assertRaises(Theme.DoesNotExist, Theme.objects.get_current)
+
+    def test_reupload_during_extraction(self):
+        theme = self._upload(default=True)
+        first_zip = Theme.objects.get(pk=theme.pk).theme_files_zip.name
+
+        def reupload():
+            self._upload(instance=Theme.objects.get(pk=theme.pk),
+                         name='Renamed', default=True)
+        with mock.patch.object(Theme, 'update_files', side_effect=reupload):
+            self.assertTrue(extract_theme(theme.pk))
+        # The finished extraction doesn't clobber the new upload.
+        theme = Theme.objects.get(pk=theme.pk)
+        self.assertEqual(theme.name, 'Renamed')
+        self.assertEqual(theme.status, Theme.PENDING)
+        self.assertNotEqual(theme.theme_files_zip.name, first_zip)
+
+        with mock.patch.object(Theme, 'update_files') as update_files:
+            self.assertEqual(extract_pending_themes(), 1)
+            self.assertEqual(update_files.call_count, 1)
+        theme = Theme.objects.get(pk=theme.pk)
+        self.assertEqual(theme.status, Theme.READY)
+        self.assertEqual(theme.name, 'Renamed')
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_extract_pending_themes__reclaim(self):
+        stuck = self._upload()
+        Theme.objects.filter(pk=stuck.pk).update(
+                status=Theme.EXTRACTING,
+                extraction_started=timezone.now() - timedelta(hours=2))
+        running = self._upload()
+        Theme.objects.filter(pk=running.pk).update(
+                status=Theme.EXTRACTING, extraction_started=timezone.now())
+        with mock.patch.object(Theme, 'update_files'):
+            self.assertEqual(extract_pending_themes(), 1)
+        self.assertEqual(Theme.objects.get(pk=stuck.pk).status, Theme.READY)
+        self.assertEqual(Theme.objects.get(pk=running.pk).status,
+                         Theme.EXTRACTING)
+
+    def test_extract_in_thread__retries_claim(self):
+        with mock.patch('uploadtemplate.tasks.time.sleep') as sleep:
+            with mock.patch('uploadtemplate.tasks.extract_theme',
+                            side_effect=[False, False, True]) as extract:
+                with mock.patch('uploadtemplate.tasks.connections'):
+                    _extract_in_thread(1, 'default')
+        self.assertEqual(extract.call_count, 3)
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_command(self):
+        theme = self._upload()
+        with mock.patch.object(Theme, 'update_files'):
+            call_command('extract_themes')
+        self.assertEqual(Theme.objects.get(pk=theme.pk).status, Theme.READY)
+
+    def test_activate__pending(self):
+        old = self.create_theme(default=True)
+        theme = self._upload()
+        theme.activate()
+        self.assertTrue(Theme.objects.get(pk=old.pk).default)
+        self.assertEqual(Theme.objects.get_current(), old)
+        with mock.patch.object(Theme, 'update_files'):
+            extract_theme(theme.pk)
+        self.assertFalse(Theme.objects.get(pk=old.pk).default)
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_reupload__still_served(self):
+        theme = self.create_theme(default=True)
+        self._upload(instance=theme, default=True)
+        self.assertEqual(Theme.objects.get(pk=theme.pk).status, Theme.PENDING)
+        self.assertEqual(Theme.objects.get_current(), theme)
+        Theme.objects.clear_cache()
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+    def test_reupload__made_default(self):
+        old = self.create_theme(default=True)
+        theme = self.create_theme()
+        self._upload(instance=theme, default=True)
+        # It has files to serve already, so it takes over straight away.
+        self.assertFalse(Theme.objects.get(pk=old.pk).default)
+        Theme.objects.clear_cache()
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+    @override_settings(UPLOADTEMPLATE_EXTRACTION='sync')
+    def test_reupload__failed(self):
+        theme = self.create_theme(default=True)
+        with mock.patch.object(Theme, 'update_files') as update_files:
+            update_files.side_effect = IOError
+            self.assertRaises(IOError, self._upload, instance=theme,
+                              default=True)
+        self.assertEqual(Theme.objects.get(pk=theme.pk).status, Theme.FAILED)
+        Theme.objects.clear_cache()
+        self.assertEqual(Theme.objects.get_current(), theme)
+
+
+class PruningTestCase(BaseTestCase):
+    def _set_prune_after(self, theme, seconds):
+        theme.prune_after = timezone.now() + timedelta(seconds=seconds)
+        Theme.objects.filter(pk=theme.pk).update(
+                                                prune_after=theme.prune_after)
+
+    def test_prune_due_themes(self):
+        due = self.create_theme(theme_zip='zips/theme.zip')
+        self._set_prune_after(due, -1)
+        later = self.create_theme(theme_zip='zips/theme.zip')
+        self._set_prune_after(later, 60)
+        with mock.patch.object(Theme, '_prune_files') as prune_files:
+            self.assertEqual(prune_due_themes(), 1)
+            self.assertEqual(prune_files.call_count, 1)
+        self.assertTrue(Theme.objects.get(pk=due.pk).prune_after is None)
+        self.assertFalse(Theme.objects.get(pk=later.pk).prune_after is None)
+
+    def test_command(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        self._set_prune_after(theme, -1)
+        with mock.patch.object(Theme, '_prune_files'):
+            call_command('prune_themes')
+            call_command('extract_themes')
+        self.assertTrue(Theme.objects.get(pk=theme.pk).prune_after is None)
+
+    @override_settings(UPLOADTEMPLATE_EXTRACTION='queue')
+    def test_next_extraction(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        self._set_prune_after(theme, -1)
+        Theme.objects.filter(pk=theme.pk).update(status=Theme.PENDING)
+        with mock.patch.object(Theme, 'update_files'):
+            with mock.patch.object(Theme, 'prune_files') as prune_files:
+                extract_theme(theme.pk)
+                prune_files.assert_called_once_with()
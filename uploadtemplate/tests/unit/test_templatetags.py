@@ -1,16 +1,21 @@
 import os
 import urlparse
+import warnings
 
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.core.files.storage import default_storage
-from django.template import Context, Variable
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.template import Context, Template, Variable
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 import mock
 
 from uploadtemplate.templatetags.uploadtemplate import static
 from uploadtemplate.templatetags.uploadtemplate_tags import GetStaticUrlNode
 from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.views import serve_static
 
 
 class StaticTestCase(BaseTestCase):
@@ -42,13 +47,106 @@ class StaticTestCase(BaseTestCase):
             storage.url.assert_called_once_with(name)
 
     def test_theme_url__nofile(self):
-        self.create_theme(default=True)
+        theme = self.create_theme(default=True)
         path = 'path/to/file.pth'
+        name = os.path.join(theme.theme_files_dir, 'static', path)
+        if default_storage.exists(name):
+            default_storage.delete(name)
         with mock.patch('uploadtemplate.templatetags.uploadtemplate.default_storage') as storage:
-            storage.exists.return_value = False
             static(Context(), path)
             self.assertFalse(storage.url.called)
 
+    def test_theme_url__manifest(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        name = os.path.join(theme.theme_files_dir, 'static', 'logo.png')
+        self.assertEqual(static(Context(), 'logo.png'),
+                         default_storage.url(name))
+        with mock.patch('uploadtemplate.utils.default_storage') as utils_storage:
+            with mock.patch('uploadtemplate.templatetags.uploadtemplate.default_storage') as storage:
+                static(Context(), 'logo.png')
+                static(Context(), 'missing.png')
+                storage.url.assert_called_once_with(name)
+                self.assertFalse(storage.exists.called)
+            self.assertFalse(utils_storage.method_calls)
+        theme.delete_files()
+
+    @override_settings(UPLOADTEMPLATE_HASH_STATIC_FILES=True)
+    def test_theme_url__hashed(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        theme.save_files()
+        name = theme.get_file_name('static/logo.png', hashed=True)
+        self.assertNotEqual(name, theme.get_file_name('static/logo.png'))
+        self.assertEqual(static(Context(), 'logo.png'),
+                         default_storage.url(name))
+        self.assertTrue(default_storage.exists(name))
+        theme.delete_files()
+
+
+class ServeFromZipTestCase(BaseTestCase):
+    @override_settings(UPLOADTEMPLATE_SERVE_FROM_ZIP=True)
+    def test_static(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        url = static(Context(), 'logo.png')
+        path = reverse('uploadtemplate-static',
+                       kwargs={'theme_id': theme.pk, 'path': 'logo.png'})
+        self.assertTrue(url.startswith(path + '?v='))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue('max-age=31536000' in response['Cache-Control'])
+        self.assertFalse(self.client.get(path).has_header('Cache-Control'))
+        with self._data_file('theme/static/logo.png') as fp:
+            self.assertEqual(response.content, fp.read())
+        self.assertRaises(Http404, serve_static, RequestFactory().get('/'),
+                          str(theme.pk), 'missing.png')
+
+    @override_settings(UPLOADTEMPLATE_SERVE_FROM_ZIP=True,
+                       UPLOADTEMPLATE_MAX_FILE_SIZE=100)
+    def test_static__too_large(self):
+        theme = self.create_theme(default=True, theme_zip='zips/theme.zip')
+        self.assertRaises(Http404, serve_static, RequestFactory().get('/'),
+                          str(theme.pk), 'logo.png')
+
+
+class StaticNodeTestCase(BaseTestCase):
+    def test_literal_memoized(self):
+        template = Template('{% load uploadtemplate %}{% static "logo.png" %}')
+        with mock.patch('uploadtemplate.templatetags.uploadtemplate.static') as static:
+            static.return_value = '/static/logo.png'
+            self.assertEqual(template.render(Context()), '/static/logo.png')
+            self.assertEqual(template.render(Context()), '/static/logo.png')
+            self.assertEqual(static.call_count, 1)
+
+            # A new current theme means new URLs.
+            theme = self.create_theme(default=True)
+            template.render(Context())
+            self.assertEqual(static.call_count, 2)
+            theme.revision += 1
+            theme.save()
+            template.render(Context())
+            self.assertEqual(static.call_count, 3)
+            template.render(Context())
+            self.assertEqual(static.call_count, 3)
+
+            with override_settings(STATIC_URL='/other/'):
+                template.render(Context())
+            self.assertEqual(static.call_count, 4)
+
+    def test_variable(self):
+        template = Template('{% load uploadtemplate %}{% static path %}')
+        with mock.patch('uploadtemplate.templatetags.uploadtemplate.static') as static:
+            static.return_value = '/static/logo.png'
+            template.render(Context({'path': 'logo.png'}))
+            template.render(Context({'path': 'logo.png'}))
+            self.assertEqual(static.call_count, 2)
+            self.assertEqual(static.call_args[0][1], 'logo.png')
+
+    def test_renders_url(self):
+        template = Template('{% load uploadtemplate %}{% static "logo.png" %}')
+        self.assertEqual(template.render(Context()),
+                         urlparse.urljoin(settings.STATIC_URL, 'logo.png'))
+
 
 class GetStaticUrlTestCase(BaseTestCase):
     def test_calls_static(self):
@@ -58,3 +156,13 @@ class GetStaticUrlTestCase(BaseTestCase):
         with mock.patch('uploadtemplate.templatetags.uploadtemplate_tags.static') as static:
             node.render(context)
             static.assert_called_once_with(context, path)
+
+    def test_literal_memoized(self):
+        with warnings.catch_warnings(record=True):
+            template = Template('{% load uploadtemplate_tags %}'
+                                '{% get_static_url "logo.png" %}')
+        with mock.patch('uploadtemplate.templatetags.uploadtemplate_tags.static') as static:
+            static.return_value = '/static/logo.png'
+            template.render(Context())
+            template.render(Context())
+            self.assertEqual(static.call_count, 1)
@@ -0,0 +1,113 @@
+import re
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage, Storage
+from django.test.utils import override_settings
+from django.utils import unittest
+import mock
+
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.utils import (delete_files, is_protected_template,
+                                  iter_files, ProtectedNames)
+
+
+class IterFilesTestCase(BaseTestCase):
+    root_dir = 'uploadtemplate/test_iter_files/'
+    file_list = ['a.txt', 'sub/b.txt', 'sub/deeper/c.txt']
+
+    def setUp(self):
+        super(IterFilesTestCase, self).setUp()
+        for name in self.file_list:
+            default_storage.save(self.root_dir + name, ContentFile('x'))
+
+    def tearDown(self):
+        for name in self.file_list:
+            default_storage.delete(self.root_dir + name)
+        super(IterFilesTestCase, self).tearDown()
+
+    def test_local(self):
+        with mock.patch.object(default_storage, 'listdir') as listdir:
+            self.assertEqual(set(iter_files(self.root_dir)),
+                             set(self.root_dir + name
+                                 for name in self.file_list))
+            self.assertFalse(listdir.called)
+        self.assertEqual(list(iter_files(self.root_dir + 'missing/')), [])
+
+    def test_listdir(self):
+        storage = mock.Mock(spec=Storage)
+        storage.path.side_effect = NotImplementedError
+        storage.exists.return_value = True
+        storage.listdir.side_effect = default_storage.listdir
+        self.assertEqual(set(iter_files(self.root_dir, storage)),
+                         set(self.root_dir + name for name in self.file_list))
+        self.assertEqual(storage.listdir.call_count, 3)
+
+        storage.exists.return_value = False
+        self.assertEqual(list(iter_files(self.root_dir, storage)), [])
+
+    def test_list_prefix(self):
+        storage = mock.Mock(spec=Storage)
+        storage.list_prefix = mock.Mock(return_value=['root/a.txt'])
+        self.assertEqual(list(iter_files('root/', storage)), ['root/a.txt'])
+        storage.list_prefix.assert_called_once_with('root/')
+        self.assertFalse(storage.listdir.called)
+
+
+class DeleteFilesTestCase(BaseTestCase):
+    names = ['file{0}'.format(i) for i in xrange(5)]
+
+    def test_delete(self):
+        storage = mock.Mock(spec=Storage)
+        self.assertEqual(delete_files(iter(self.names), storage, workers=1),
+                         5)
+        self.assertEqual([args[0] for args, kwargs
+                          in storage.delete.call_args_list], self.names)
+
+    def test_thread_pool(self):
+        storage = mock.Mock(spec=Storage)
+        with mock.patch('uploadtemplate.utils.DELETE_BATCH_SIZE', 2):
+            self.assertEqual(delete_files(iter(self.names), storage,
+                                          workers=3), 5)
+        self.assertEqual(sorted(args[0] for args, kwargs
+                                in storage.delete.call_args_list), self.names)
+
+    def test_delete_many(self):
+        storage = mock.Mock(spec=Storage)
+        storage.delete_many = mock.Mock()
+        with mock.patch('uploadtemplate.utils.DELETE_BATCH_SIZE', 2):
+            self.assertEqual(delete_files(iter(self.names), storage,
+                                          workers=3), 5)
+        self.assertEqual(storage.delete_many.call_args_list,
+                         [((self.names[0:2],), {}), ((self.names[2:4],), {}),
+                          ((self.names[4:],), {})])
+        self.assertFalse(storage.delete.called)
+
+
+class ProtectedNamesTestCase(unittest.TestCase):
+    def test_merged(self):
+        backreference = re.compile(r'(x)\1')
+        protected = ProtectedNames(['^admin/', 'private', 'invalid[',
+                                    re.compile('secret', re.I),
+                                    backreference])
+        self.assertEqual(len(protected.regexps), 2)
+        self.assertEqual(protected.others, [backreference])
+        self.assertTrue(protected('admin/index.html'))
+        self.assertTrue(protected('private/index.html'))
+        self.assertTrue(protected('SECRET.html'))
+        self.assertTrue(protected('xx.html'))
+        self.assertFalse(protected('index.html'))
+        self.assertFalse(protected('index/admin/'))
+
+    def test_results_cached(self):
+        protected = ProtectedNames(['^admin/'])
+        self.assertTrue(protected('admin/index.html'))
+        with mock.patch.object(protected, '_match') as match:
+            self.assertTrue(protected('admin/index.html'))
+            self.assertFalse(match.called)
+
+    def test_setting_changed(self):
+        self.assertFalse(is_protected_template('admin/index.html'))
+        with override_settings(
+                UPLOADTEMPLATE_PROTECTED_TEMPLATE_NAMES=['^admin/']):
+            self.assertTrue(is_protected_template('admin/index.html'))
+        self.assertFalse(is_protected_template('admin/index.html'))
@@ -0,0 +1,114 @@
+from StringIO import StringIO
+import tempfile
+import zipfile
+
+from django.core.urlresolvers import reverse
+from django.http import Http404
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.utils import stream_zip
+from uploadtemplate.views import download
+
+
+@override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/',
+                   UPLOADTEMPLATE_DOWNLOAD_CHUNK_SIZE=100)
+class DownloadTestCase(BaseTestCase):
+    def setUp(self):
+        super(DownloadTestCase, self).setUp()
+        self.theme = self.create_theme(name='My Theme',
+                                       theme_zip='zips/theme.zip')
+        self.url = reverse('uploadtemplate-download', args=(self.theme.pk,))
+        with self._data_file('zips/theme.zip') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        self.theme.delete_files()
+        super(DownloadTestCase, self).tearDown()
+
+    def test_stored_zip(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="my-theme.zip"')
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertEqual(''.join(response), self.content)
+
+    def test_not_modified(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(
+                    self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_range(self):
+        size = len(self.content)
+        for header, first, last in (('bytes=0-9', 0, 9),
+                                    ('bytes=150-', 150, size - 1),
+                                    ('bytes=-20', size - 20, size - 1),
+                                    ('bytes=10-99999', 10, size - 1)):
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response['Content-Range'],
+                             'bytes {0}-{1}/{2}'.format(first, last, size))
+            self.assertEqual(''.join(response),
+                             self.content[first:last + 1])
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=99999-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'],
+                         'bytes */{0}'.format(size))
+
+        # Multiple ranges, and ranges for an old version, get everything.
+        for extra in ({'HTTP_RANGE': 'bytes=0-1,5-6'},
+                      {'HTTP_RANGE': 'bytes=0-9', 'HTTP_IF_RANGE': '"old"'}):
+            response = self.client.get(self.url, **extra)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(''.join(response), self.content)
+
+    def test_generated(self):
+        self.theme.save_files()
+        self.theme.theme_files_zip.delete()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'none')
+        self.assertFalse(response.has_header('Content-Length'))
+        self.assertTrue(response['ETag'].startswith('W/'))
+        zip_file = zipfile.ZipFile(StringIO(''.join(response)))
+        original = zipfile.ZipFile(self._data_file('zips/theme.zip'))
+        self.assertEqual(sorted(zip_file.namelist()),
+                         ['static/logo.png',
+                          'templates/uploadtemplate/index.html'])
+        for name in zip_file.namelist():
+            self.assertEqual(zip_file.read(name), original.read(name))
+
+        response = self.client.get(self.url,
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing(self):
+        self.theme.theme_files_zip.delete()
+        self.assertRaises(Http404, download, RequestFactory().get(self.url),
+                          self.theme.pk)
+
+
+class StreamZipTestCase(BaseTestCase):
+    def test_chunks(self):
+        entries = [('a.txt', lambda: StringIO('a' * 1000)),
+                   ('b.txt', lambda: StringIO('b' * 10))]
+        chunks = list(stream_zip(entries, chunk_size=64))
+        self.assertTrue(all(len(chunk) == 64 for chunk in chunks[:-1]))
+        content = ''.join(chunks)
+        self.assertEqual(content, ''.join(stream_zip(entries)))
+        zip_file = zipfile.ZipFile(StringIO(content))
+        self.assertEqual(zip_file.read('a.txt'), 'a' * 1000)
+        self.assertEqual(zip_file.read('b.txt'), 'b' * 10)
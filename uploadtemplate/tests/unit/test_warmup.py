@@ -0,0 +1,74 @@
+import tempfile
+
+from django.contrib.sites.models import Site
+from django.template import Context
+from django.test.utils import override_settings
+import mock
+
+from uploadtemplate import cache
+from uploadtemplate.instrumentation import StorageCallsTestMixin
+from uploadtemplate.loader import CachedLoader
+from uploadtemplate.models import Theme
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.warmup import warm_up
+
+
+@override_settings(UPLOADTEMPLATE_MEDIA_ROOT=tempfile.gettempdir() + '/')
+class WarmUpTestCase(StorageCallsTestMixin, BaseTestCase):
+    def setUp(self):
+        super(WarmUpTestCase, self).setUp()
+        self.theme = self.create_theme(default=True,
+                                       theme_zip='zips/theme.zip')
+        self.theme.save_files()
+        self.other_site = Site.objects.create(domain='other.invalid',
+                                              name='Other')
+        Theme.objects.clear_cache()
+        cache.clear()
+
+    def tearDown(self):
+        self.theme.delete_files()
+        super(WarmUpTestCase, self).tearDown()
+
+    def test_warm_up(self):
+        results = warm_up()
+        self.assertEqual([(result.site, result.theme) for result in results],
+                         [(self.theme.site, self.theme),
+                          (self.other_site, None)])
+        self.assertEqual([step for step, seconds in results[0].timings],
+                         ['theme', 'files', 'template manifest',
+                          'static manifest', 'templates'])
+        self.assertEqual(results[0].errors, [])
+        self.assertTrue('no default theme' in results[1].format())
+
+        # Nothing is left for the first request to look up or read.
+        with mock.patch.object(Theme.objects, '_get_default') as get_default:
+            with self.assertNumStorageCalls(0):
+                theme = Theme.objects.get_current()
+                CachedLoader().load_template_source(
+                                            'uploadtemplate/index.html')
+            self.assertFalse(get_default.called)
+        self.assertTrue(theme is results[0].theme)
+        self.assertEqual(len(cache.compiled_template_cache), 0)
+
+    def test_compile_templates(self):
+        results = warm_up(compile_templates=True)
+        self.assertEqual(results[0].timings[-1][0], 'compile')
+        self.assertEqual(results[0].errors, [])
+        with mock.patch('uploadtemplate.loader.get_template_from_string'
+                        ) as get_template_from_string:
+            template, origin = CachedLoader().load_template(
+                                                'uploadtemplate/index.html')
+            self.assertFalse(get_template_from_string.called)
+        self.assertTrue(origin is None)
+        template.render(Context())
+
+    def test_compile_errors(self):
+        with mock.patch.object(CachedLoader, 'load_theme_template',
+                               side_effect=ValueError):
+            results = warm_up(compile_templates=True)
+        self.assertEqual(results[0].errors, ['uploadtemplate/index.html'])
+
+    def test_closes_connection(self):
+        with mock.patch('uploadtemplate.warmup.close_connection') as close:
+            warm_up()
+            close.assert_called_once_with()
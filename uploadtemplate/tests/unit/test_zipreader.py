@@ -0,0 +1,70 @@
+import tempfile
+import zipfile
+
+from django.test.utils import override_settings
+
+from uploadtemplate.extraction import ThemeSizeError
+from uploadtemplate.tests import BaseTestCase
+from uploadtemplate.zipreader import ZipReader, open_zip_reader
+
+
+class ZipReaderTestCase(BaseTestCase):
+    def test_read(self):
+        reader = ZipReader(self._data_file('zips/theme.zip'))
+        zip_file = zipfile.ZipFile(self._data_file_path('zips/theme.zip'))
+        self.assertEqual(set(reader.namelist()),
+                         set(['static/logo.png',
+                              'templates/uploadtemplate/index.html']))
+        for name in reader.namelist():
+            self.assertTrue(name in reader)
+            self.assertEqual(reader.read(name), zip_file.read(name))
+        self.assertFalse('static/' in reader)
+        self.assertRaises(KeyError, reader.read, 'missing')
+        zip_file.close()
+        reader.close()
+
+    def _bomb(self):
+        fp = tempfile.TemporaryFile()
+        zip_file = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED)
+        zip_file.writestr('static/bomb.txt', 'x' * 1000000)
+        zip_file.writestr('static/small.txt', 'small')
+        zip_file.close()
+        fp.seek(0)
+        return ZipReader(fp)
+
+    def test_iter_chunks(self):
+        reader = self._bomb()
+        chunks = list(reader.iter_chunks('static/bomb.txt', 4096))
+        self.assertEqual(len(chunks), 245)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 4096)
+        self.assertEqual(''.join(chunks), 'x' * 1000000)
+        reader.close()
+
+    def test_iter_chunks__understated_size(self):
+        """
+        A member which uncompresses to more than its recorded size is
+        rejected before more than that is decompressed.
+
+        """
+        reader = self._bomb()
+        reader.getinfo('static/bomb.txt').file_size = 10000
+        chunks = reader.iter_chunks('static/bomb.txt', 4096)
+        self.assertEqual(len(chunks.next()), 4096)
+        self.assertEqual(len(chunks.next()), 4096)
+        self.assertRaises(zipfile.BadZipfile, chunks.next)
+        reader.close()
+
+    @override_settings(UPLOADTEMPLATE_MAX_FILE_SIZE=1000)
+    def test_iter_chunks__max_file_size(self):
+        reader = self._bomb()
+        self.assertRaises(ThemeSizeError, reader.iter_chunks,
+                          'static/bomb.txt')
+        self.assertRaises(ThemeSizeError, reader.read, 'static/bomb.txt')
+        self.assertEqual(reader.read('static/small.txt'), 'small')
+        reader.close()
+
+    def test_open_zip_reader(self):
+        theme = self.create_theme(theme_zip='zips/theme.zip')
+        reader = open_zip_reader(theme.theme_files_zip)
+        self.assertTrue('static/logo.png' in reader)
+        reader.close()
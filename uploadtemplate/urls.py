@@ -11,7 +11,7 @@ urlpatterns = patterns('uploadtemplate.views',
     url(r'^(\d+)/delete$', 'delete', name='uploadtemplate-delete'),
     url(r'^unset_default$', 'unset_default', name='uploadtemplate-unset_default'),
     url(r'^set_default/(\d+)$', 'set_default', name='uploadtemplate-set_default'),
-
-    # Backwards-compat. Just 404s.
+    url(r'^(?P<theme_id>\d+)/static/(?P<path>.+)$', 'serve_static',
+        name='uploadtemplate-static'),
     url(r'^download/(\d+)$', 'download', name='uploadtemplate-download')
 )
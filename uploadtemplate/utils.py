@@ -1,50 +1,107 @@
+import errno
+import itertools
+import mimetypes
 import os
+import posixpath
 import re
+import shutil
 import zipfile
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 from django.core.files.storage import default_storage
+from django.test.signals import setting_changed
 
 
+# Maps each protected names setting to the ProtectedNames built from it.
 PROTECTED_RE_CACHE = {}
 
+# Backreferences would refer to the wrong groups once a pattern is merged
+# with others.
+_BACKREFERENCE_RE = re.compile(r'\\[1-9]|\(\?P=')
 
-def _is_protected(name, setting):
-    # The setting is expected to be a list of compiled regular
-    # expressions or strings to be compiled.
-    if setting not in PROTECTED_RE_CACHE:
-        try:
-            protected_names = getattr(settings, setting)
-        except AttributeError:
-            protected_names = []
 
-        try:
-            protected_names = list(protected_names)
-        except TypeError:
-            protected_names = []
+class ProtectedNames(object):
+    """
+    Checks names against a list of regular expressions, compiled or as
+    strings. Compiled patterns with the same flags are merged into a single
+    alternation, so that each check is one match per set of flags rather
+    than one per pattern, and recent answers are kept in an LRU cache of
+    ``cache_size`` names.
 
-        regexps = []
-        for regexp in protected_names:
-            if isinstance(regexp, basestring):
+    """
+    def __init__(self, patterns, cache_size=1000):
+        from uploadtemplate.cache import LRUCache
+        by_flags = {}
+        # Objects which aren't regular expressions but have a match method.
+        self.others = []
+        for pattern in patterns:
+            if isinstance(pattern, basestring):
                 try:
-                    regexps.append(re.compile(regexp))
+                    pattern = re.compile(pattern)
                 except re.error:
-                    pass
+                    continue
+            source = getattr(pattern, 'pattern', None)
+            flags = getattr(pattern, 'flags', None)
+            if (isinstance(source, basestring) and isinstance(flags, int) and
+                not _BACKREFERENCE_RE.search(source)):
+                by_flags.setdefault(flags, []).append(source)
+            else:
+                self.others.append(pattern)
+
+        self.regexps = []
+        for flags, sources in by_flags.iteritems():
+            try:
+                self.regexps.append(re.compile(
+                    '|'.join('(?:{0})'.format(source) for source in sources),
+                    flags))
+            except (re.error, AssertionError):
+                # e.g. too many groups between them.
+                self.regexps.extend(re.compile(source, flags)
+                                    for source in sources)
+        self._results = LRUCache(cache_size, sizeof=lambda result: 1)
+
+    def __call__(self, name):
+        result = self._results.get(name)
+        if result is None:
+            result = self._match(name)
+            self._results.set(name, result)
+        return result
+
+    def _match(self, name):
+        for regexp in self.regexps:
+            if regexp.match(name):
+                return True
+        for other in self.others[:]:
+            try:
+                protected = other.match(name)
+            except (AttributeError, TypeError):
+                self.others.remove(other)
             else:
-                regexps.append(regexp)
+                if protected:
+                    return True
+        return False
 
-        PROTECTED_RE_CACHE[setting] = regexps
 
-    for regexp in PROTECTED_RE_CACHE[setting][:]:
+def _is_protected(name, setting):
+    # The setting is expected to be a list of compiled regular
+    # expressions or strings to be compiled.
+    protected_names = PROTECTED_RE_CACHE.get(setting)
+    if protected_names is None:
         try:
-            protected = regexp.match(name)
+            patterns = list(getattr(settings, setting))
         except (AttributeError, TypeError):
-            PROTECTED_RE_CACHE[setting].remove(regexp)
-        else:
-            if protected:
-                return True
+            patterns = []
+        protected_names = ProtectedNames(patterns, getattr(settings,
+                            'UPLOADTEMPLATE_PROTECTED_NAME_CACHE_SIZE', 1000))
+        PROTECTED_RE_CACHE[setting] = protected_names
+    return protected_names(name)
 
-    return False
+
+def _setting_changed(sender, setting, **kwargs):
+    PROTECTED_RE_CACHE.pop(setting, None)
+setting_changed.connect(_setting_changed)
 
 
 def is_protected_template(name):
@@ -55,6 +112,15 @@ def is_protected_static_file(name):
     return _is_protected(name, 'UPLOADTEMPLATE_PROTECTED_STATIC_FILES')
 
 
+def serve_from_zip():
+    """
+    Returns ``True`` if theme files should be read straight from each
+    theme's zip file rather than extracted to storage.
+
+    """
+    return getattr(settings, 'UPLOADTEMPLATE_SERVE_FROM_ZIP', False)
+
+
 def is_zipfile(fp):
     """
     This is a version of zipfile.is_zipfile, adjusted to only work for file
@@ -69,12 +135,247 @@ def is_zipfile(fp):
     return False
 
 
-def list_files(root_dir):
+def get_zip_manifest(zip_file):
+    """
+    Returns a dictionary describing each file (but not directory) in the
+    given :class:`zipfile.ZipFile`, keyed by its name in the archive.
+
+    """
+    manifest = {}
+    for info in zip_file.infolist():
+        if info.filename.endswith('/'):
+            continue
+        content_type = mimetypes.guess_type(info.filename)[0]
+        manifest[info.filename] = {
+            'size': info.file_size,
+            'crc': info.CRC,
+            'content_type': content_type or 'application/octet-stream',
+        }
+    return manifest
+
+
+def iter_files(root_dir, storage=None):
+    """
+    Yields the names of all files under ``root_dir`` in ``storage`` (by
+    default, the default storage), without building the whole list.
+
+    Storages which can list everything under a prefix in one request may
+    provide a ``list_prefix(prefix)`` method returning an iterable of file
+    names, which is used instead of walking directories. Storages with
+    local paths are walked with :func:`os.walk`; any others are walked one
+    :meth:`listdir` at a time.
+
+    """
+    if storage is None:
+        storage = default_storage
+
+    list_prefix = getattr(storage, 'list_prefix', None)
+    if list_prefix is not None:
+        for name in list_prefix(root_dir):
+            yield name
+        return
+
+    try:
+        local_root = storage.path(root_dir)
+    except NotImplementedError:
+        local_root = None
+    if local_root is not None:
+        for dir_path, dirs, filenames in os.walk(local_root):
+            relative = os.path.relpath(dir_path, local_root)
+            if relative == os.curdir:
+                prefix = root_dir
+            else:
+                prefix = posixpath.join(root_dir,
+                                        relative.replace(os.sep, '/'))
+            for filename in filenames:
+                yield posixpath.join(prefix, filename)
+        return
+
     # Trying to list a dir that doesn't exist can cause errors.
-    if not default_storage.exists(root_dir):
-        return []
-    directories, filenames = default_storage.listdir(root_dir)
-    files = [os.path.join(root_dir, name) for name in filenames]
-    for dirname in directories:
-        files.extend(list_files(os.path.join(root_dir, dirname)))
-    return files
+    if not storage.exists(root_dir):
+        return
+    pending = deque([root_dir])
+    while pending:
+        dir_name = pending.popleft()
+        directories, filenames = storage.listdir(dir_name)
+        for filename in filenames:
+            yield posixpath.join(dir_name, filename)
+        for directory in directories:
+            pending.append(posixpath.join(dir_name, directory))
+
+
+def list_files(root_dir):
+    """
+    Returns a list of the names of all files under ``root_dir`` in the
+    default storage. See :func:`iter_files`.
+
+    """
+    return list(iter_files(root_dir))
+
+
+# Number of names handed to the storage (or the thread pool) at a time by
+# delete_files.
+DELETE_BATCH_SIZE = 1000
+
+
+def delete_files(names, storage=None, workers=None):
+    """
+    Deletes the files named by the iterable ``names`` from ``storage`` (by
+    default, the default storage), and returns how many there were. Names
+    are consumed in batches, so ``names`` may be a generator such as
+    :func:`iter_files`.
+
+    Storages which can delete many files in one request may provide a
+    ``delete_many(names)`` method, which is called once per batch.
+    Otherwise, if ``workers`` (which defaults to
+    ``UPLOADTEMPLATE_DELETE_WORKERS``) is greater than one, files are
+    deleted from a pool of that many threads.
+
+    """
+    if storage is None:
+        storage = default_storage
+    if workers is None:
+        workers = getattr(settings, 'UPLOADTEMPLATE_DELETE_WORKERS', 1)
+
+    delete_many = getattr(storage, 'delete_many', None)
+    pool = None
+    if delete_many is None and workers > 1:
+        pool = ThreadPool(workers)
+    count = 0
+    names = iter(names)
+    try:
+        while True:
+            batch = list(itertools.islice(names, DELETE_BATCH_SIZE))
+            if not batch:
+                break
+            if delete_many is not None:
+                delete_many(batch)
+            elif pool is not None:
+                pool.map(storage.delete, batch)
+            else:
+                for name in batch:
+                    storage.delete(name)
+            count += len(batch)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return count
+
+
+def remove_local_dir(path):
+    """
+    Removes a local directory and everything in it, if it exists.
+
+    """
+    try:
+        shutil.rmtree(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def get_download_chunk_size():
+    return getattr(settings, 'UPLOADTEMPLATE_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+
+def iter_file_chunks(open_file, start=0, length=None, chunk_size=None):
+    """
+    Yields ``length`` bytes (or everything) from ``start`` in the file
+    returned by ``open_file()``, ``chunk_size`` bytes at a time. The file
+    isn't opened until the first chunk is asked for, and is closed once the
+    last has been yielded or the iteration is abandoned.
+
+    """
+    if chunk_size is None:
+        chunk_size = get_download_chunk_size()
+    fp = open_file()
+    try:
+        if start:
+            fp.seek(start)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size,
+                                                            remaining)
+            data = fp.read(size)
+            if not data:
+                break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+    finally:
+        fp.close()
+
+
+# The timestamp given to every file in a streamed zip file, so that the same
+# files always make the same archive.
+STREAMED_ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+class _ZipStream(object):
+    """
+    A write-only file for :class:`zipfile.ZipFile` which keeps what has been
+    written until it's taken with :meth:`take`.
+
+    """
+    def __init__(self):
+        self._buffer = []
+        self._buffered = 0
+        self._position = 0
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self, chunk_size, everything=False):
+        """
+        Returns a list of the ``chunk_size`` chunks written so far. The
+        remainder is kept back, unless ``everything`` is true.
+
+        """
+        if self._buffered < chunk_size and not everything:
+            return []
+        data = ''.join(self._buffer)
+        end = len(data) if everything else (len(data) // chunk_size *
+                                            chunk_size)
+        chunks = [data[i:i + chunk_size] for i in xrange(0, end, chunk_size)]
+        self._buffer = [data[end:]] if end < len(data) else []
+        self._buffered = len(data) - end
+        return chunks
+
+
+def stream_zip(entries, chunk_size=None):
+    """
+    Yields the contents of a zip file, ``chunk_size`` bytes at a time,
+    holding the files in ``entries``: ``(name, open_file)`` pairs, where
+    ``open_file()`` returns the file to be stored as ``name``. Files are
+    read and compressed one at a time, so only one of them is in memory at
+    once.
+
+    """
+    if chunk_size is None:
+        chunk_size = get_download_chunk_size()
+    stream = _ZipStream()
+    zip_file = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for name, open_file in entries:
+        fp = open_file()
+        try:
+            content = fp.read()
+        finally:
+            fp.close()
+        info = zipfile.ZipInfo(name, date_time=STREAMED_ZIP_DATE_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0644 << 16
+        zip_file.writestr(info, content)
+        for chunk in stream.take(chunk_size):
+            yield chunk
+    zip_file.close()
+    for chunk in stream.take(chunk_size, everything=True):
+        yield chunk
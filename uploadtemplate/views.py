@@ -1,12 +1,40 @@
+import hashlib
+import mimetypes
+import os
+import re
+import time
+from functools import partial
+
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.core.urlresolvers import reverse, reverse_lazy
-from django.http import HttpResponseRedirect, Http404
+from django.http import (HttpResponse, HttpResponseNotModified,
+                         HttpResponseRedirect, Http404)
 from django.shortcuts import get_object_or_404
+from django.template.defaultfilters import slugify
+from django.utils.cache import patch_cache_control
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
 from django.views.generic import ListView, CreateView, UpdateView
 
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams any response whose content is an iterator.
+    StreamingHttpResponse = HttpResponse
+
+from uploadtemplate.cache import (get_static_manifest, get_template_manifest,
+                                  get_theme_files, get_zip_reader)
+from uploadtemplate.extraction import ThemeSizeError
 from uploadtemplate.forms import ThemeForm
 from uploadtemplate.models import Theme
+from uploadtemplate.utils import (get_download_chunk_size,
+                                  is_protected_static_file, iter_file_chunks,
+                                  stream_zip)
+
 
+# Cache lifetime, in seconds, for responses whose URL is versioned.
+FAR_FUTURE = 365 * 24 * 60 * 60
 
 class ThemeCreateView(CreateView):
     form_class = ThemeForm
@@ -59,7 +87,7 @@ def unset_default(request):
     This removes any them as set, to fall back to the default templates.
     '''
     Theme.objects.filter(site=settings.SITE_ID, default=True).update(default=False)
-    Theme.objects.clear_cache()
+    Theme.objects.invalidate(settings.SITE_ID)
     return HttpResponseRedirect(reverse('uploadtemplate-index'))
 
 
@@ -67,9 +95,8 @@ def set_default(request, theme_id):
     """Sets a theme as the default."""
     theme = get_object_or_404(Theme, pk=theme_id)
     if not theme.default:
-        Theme.objects.filter(site=settings.SITE_ID, default=True).update(default=False)
-        theme.default = True
-        theme.save()
+        # Themes whose files aren't ready yet take over once they are.
+        theme.activate()
     return HttpResponseRedirect(reverse('uploadtemplate-index'))
 
 
@@ -79,5 +106,229 @@ def delete(request, theme_id):
     return HttpResponseRedirect(reverse('uploadtemplate-index'))
 
 
+def serve_static(request, theme_id, path):
+    """
+    Serves a static file straight out of a theme's zip file. Used when
+    ``UPLOADTEMPLATE_SERVE_FROM_ZIP`` is set.
+
+    Requests whose ``v`` parameter matches the file's CRC, as in the URLs
+    generated by the ``static`` tag, are marked as cacheable for a year.
+    The file is decompressed as it's streamed, and files larger than
+    ``UPLOADTEMPLATE_MAX_FILE_SIZE`` aren't served.
+
+    """
+    try:
+        theme = Theme.objects.get_current()
+    except Theme.DoesNotExist:
+        theme = None
+    if theme is None or theme.pk != int(theme_id):
+        theme = get_object_or_404(Theme, pk=theme_id)
+
+    if not theme.theme_files_zip or is_protected_static_file(path):
+        raise Http404
+    reader = get_zip_reader(theme)
+    name = 'static/' + path
+    if name not in reader:
+        raise Http404
+
+    info = reader.getinfo(name)
+    try:
+        chunks = reader.iter_chunks(name, get_download_chunk_size())
+    except ThemeSizeError:
+        raise Http404
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Length'] = info.file_size
+    if request.GET.get('v') == '{0:08x}'.format(info.CRC):
+        patch_cache_control(response, public=True, max_age=FAR_FUTURE)
+    return response
+
+
 def download(request, theme_id):
-    raise Http404
+    """
+    Streams a theme as a zip file. Themes with a stored zip file get it
+    back, with support for conditional and range requests; for other
+    themes, a zip file is made on the fly from their extracted (or legacy)
+    files.
+
+    """
+    theme = get_object_or_404(Theme, pk=theme_id)
+    filename = '{0}.zip'.format(slugify(theme.name) or
+                                'theme-{0}'.format(theme.pk))
+
+    size = None
+    if theme.theme_files_zip:
+        try:
+            size = theme.theme_files_zip.size
+        except (IOError, OSError):
+            # The zip file has gone missing; make a new one instead.
+            pass
+
+    if size is None:
+        entries = _archive_entries(theme)
+        if not entries:
+            raise Http404
+        etag = 'W/' + quote_etag(_archive_etag(theme, entries))
+        response = _not_modified(request, etag, None)
+        if response is None:
+            response = StreamingHttpResponse(stream_zip(entries),
+                                             content_type='application/zip')
+            response['Accept-Ranges'] = 'none'
+    else:
+        name = theme.theme_files_zip.name
+        last_modified = _modified_time(name)
+        etag = quote_etag(hashlib.md5('{0}:{1}:{2}'.format(
+                                name, size, last_modified)).hexdigest())
+        response = _not_modified(request, etag, last_modified)
+        if response is None:
+            response = _stream_range(request, partial(default_storage.open,
+                                                      name),
+                                     size, etag, last_modified)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+
+    response['ETag'] = etag
+    if response.status_code != 304:
+        response['Content-Disposition'] = (
+                            'attachment; filename="{0}"'.format(filename))
+    return response
+
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _stream_range(request, open_file, size, etag, last_modified):
+    """
+    Returns a streaming response for the file returned by ``open_file()``,
+    which is ``size`` bytes long: all of it, or the single range of bytes
+    asked for by the request's ``Range`` header.
+
+    """
+    byte_range = None
+    if _if_range_matches(request, etag, last_modified):
+        try:
+            byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{0}'.format(size)
+            return response
+
+    if byte_range is None:
+        start, length = 0, size
+    else:
+        start, length = byte_range[0], byte_range[1] - byte_range[0] + 1
+    response = StreamingHttpResponse(iter_file_chunks(open_file, start,
+                                                      length),
+                                     content_type='application/zip')
+    if byte_range is not None:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                                            byte_range[0], byte_range[1], size)
+    response['Content-Length'] = length
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _parse_range(header, size):
+    """
+    Returns the first and last byte asked for by a ``Range`` header, or
+    ``None`` if the whole file should be sent. Multiple ranges aren't
+    supported; those requests get the whole file. Raises ``ValueError`` if
+    the range lies outside the file.
+
+    """
+    match = _RANGE_RE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # A suffix: the last so many bytes.
+        if not int(last):
+            raise ValueError
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if first >= size:
+        raise ValueError
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        return None
+    return first, last
+
+
+def _if_range_matches(request, etag, last_modified):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None:
+        return True
+    if if_range == etag:
+        return True
+    return (last_modified is not None and
+            parse_http_date_safe(if_range) == int(last_modified))
+
+
+def _not_modified(request, etag, last_modified):
+    """
+    Returns a 304 response if the request's conditional headers show that
+    the client already has the current version, otherwise ``None``.
+
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        if '*' not in etags and parse_etags(etag)[0] not in etags:
+            return None
+    else:
+        if_modified_since = parse_http_date_safe(
+                        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if (last_modified is None or if_modified_since is None or
+            int(last_modified) > if_modified_since):
+            return None
+    return HttpResponseNotModified()
+
+
+def _modified_time(name):
+    """
+    Returns the time at which the stored file was last modified, as a
+    timestamp, or ``None`` if the storage can't tell.
+
+    """
+    try:
+        modified = default_storage.modified_time(name)
+    except (NotImplementedError, IOError, OSError):
+        return None
+    return time.mktime(modified.timetuple())
+
+
+def _archive_entries(theme):
+    """
+    Returns ``(name, open_file)`` pairs for the files to put in a zip file
+    made from the theme's extracted files and legacy directories, for
+    :func:`~uploadtemplate.utils.stream_zip`.
+
+    """
+    entries = {}
+    for name in get_theme_files(theme):
+        if name.endswith('/'):
+            continue
+        storage_name = theme.get_file_name(name)
+        if storage_name is not None:
+            entries[name] = partial(default_storage.open, storage_name)
+    legacy = (('templates/', theme.template_dir,
+               get_template_manifest(theme)[1]),
+              ('static/', theme.static_root, get_static_manifest(theme)[1]))
+    for prefix, get_root, paths in legacy:
+        for path in paths:
+            entries.setdefault(prefix + path,
+                               partial(open, os.path.join(get_root(), path),
+                                       'rb'))
+    return sorted(entries.items())
+
+
+def _archive_etag(theme, entries):
+    # The theme's revision and manifest change whenever its extracted files
+    # do; legacy files are only accounted for by their names.
+    return hashlib.md5('{0}:{1}:{2}:{3}'.format(
+                            theme.pk, theme.revision, theme.manifest,
+                            ','.join(name for name, open_file in entries))
+                       ).hexdigest()
@@ -0,0 +1,119 @@
+"""
+Warming of the in-process theme caches, so that the first requests served
+by a new process don't pay for theme lookups, listings of theme files and
+template parsing.
+
+Call :func:`warm_up` once the process has loaded Django, e.g. from a WSGI
+preload hook in ``wsgi.py``, or run ``manage.py warm_theme_caches``.
+
+"""
+import logging
+from collections import namedtuple
+from timeit import default_timer
+
+from django.contrib.sites.models import Site
+from django.db import close_connection
+from django.template import TemplateDoesNotExist
+
+from uploadtemplate.cache import (get_static_manifest, get_template_manifest,
+                                  get_theme_files, get_zip_reader)
+from uploadtemplate.loader import CachedLoader
+from uploadtemplate.models import Theme
+from uploadtemplate.utils import serve_from_zip
+
+
+logger = logging.getLogger(__name__)
+
+
+class WarmUpResult(namedtuple('WarmUpResult', 'site theme timings errors')):
+    """
+    What :func:`warm_up` did for one site: ``theme`` is its default theme
+    (or ``None``), ``timings`` a list of ``(step, seconds)`` tuples in the
+    order the steps ran, and ``errors`` the names of templates which
+    couldn't be loaded or compiled.
+
+    """
+    @property
+    def seconds(self):
+        return sum(seconds for step, seconds in self.timings)
+
+    def format(self):
+        if self.theme is None:
+            return "{0}: no default theme".format(self.site)
+        steps = ', '.join('{0} {1:.1f}ms'.format(step, seconds * 1000)
+                          for step, seconds in self.timings)
+        line = "{0}: {1} ({2:.1f}ms: {3})".format(self.site, self.theme,
+                                                 self.seconds * 1000, steps)
+        if self.errors:
+            line += "; {0} template(s) failed".format(len(self.errors))
+        return line
+
+
+def warm_up(compile_templates=False, using='default'):
+    """
+    Looks up the default theme of every site and fills the caches for it:
+    the theme itself, its list of files, its template and static manifests
+    and, when serving from zip files, its zip reader. Every theme template
+    is read into the template cache; with ``compile_templates``, they are
+    also compiled into the cache used by
+    :class:`~uploadtemplate.loader.CachedLoader`.
+
+    Returns a list with a :class:`WarmUpResult` for each site.
+
+    Database connections are closed afterwards, so that processes forked
+    from a preloading server don't share the connection used here.
+
+    """
+    loader = CachedLoader()
+    results = []
+    try:
+        for site in Site.objects.order_by('pk'):
+            results.append(_warm_up_site(site, loader, compile_templates,
+                                         using))
+    finally:
+        close_connection()
+    return results
+
+
+def _warm_up_site(site, loader, compile_templates, using):
+    timings, errors = [], []
+
+    def step(name, func, *args):
+        start = default_timer()
+        value = func(*args)
+        timings.append((name, default_timer() - start))
+        return value
+
+    try:
+        theme = step('theme', Theme.objects.get_cached, site.pk, using)
+    except Theme.DoesNotExist:
+        return WarmUpResult(site, None, timings, errors)
+
+    step('files', get_theme_files, theme)
+    theme_templates, legacy_templates = step('template manifest',
+                                             get_template_manifest, theme)
+    step('static manifest', get_static_manifest, theme)
+    if serve_from_zip() and theme.theme_files_zip:
+        step('zip', get_zip_reader, theme)
+
+    def read_templates():
+        for name in theme_templates:
+            try:
+                loader.load_theme_template_source(theme, name)
+            except TemplateDoesNotExist:
+                # Protected names, or files removed since they were listed.
+                pass
+    step('templates', read_templates)
+
+    def compile_all():
+        for name in sorted(theme_templates | legacy_templates):
+            try:
+                loader.load_theme_template(theme, name)
+            except Exception, e:
+                # Template tags may raise anything while being compiled.
+                logger.warning("Couldn't compile template %s of theme %s: "
+                               "%s", name, theme.pk, e)
+                errors.append(name)
+    if compile_templates:
+        step('compile', compile_all)
+    return WarmUpResult(site, theme, timings, errors)
@@ -0,0 +1,182 @@
+"""
+Read-only access to theme files straight out of a theme's zip file.
+
+"""
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+import zlib
+
+from uploadtemplate.extraction import (CHUNK_SIZE, ThemeSizeError,
+                                       get_max_file_size)
+
+
+_LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+_LOCAL_HEADER_SIZE = struct.calcsize(_LOCAL_HEADER_FORMAT)
+_LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+# Indexes of the file name and extra field lengths in the local header.
+_NAME_LENGTH, _EXTRA_LENGTH = 10, 11
+
+
+class ZipReader(object):
+    """
+    Memory-maps a zip file and reads members from it by slicing the map at
+    offsets taken from the central directory, which is indexed once when
+    the reader is created. Stored and deflated members are read without
+    any locking, so a single reader can be shared between threads.
+
+    Members are decompressed a chunk at a time, and may not uncompress to
+    more than the size recorded for them, nor be recorded as larger than
+    ``UPLOADTEMPLATE_MAX_FILE_SIZE`` bytes.
+
+    ``fp`` must be a real file, opened for reading in binary mode. It is
+    kept open for as long as the reader is.
+
+    """
+    def __init__(self, fp):
+        self._fp = fp
+        self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._zip_file = zipfile.ZipFile(fp)
+        self._lock = threading.Lock()
+        self._index = dict((info.filename, info)
+                           for info in self._zip_file.infolist()
+                           if not info.filename.endswith('/'))
+        self._offsets = {}
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def namelist(self):
+        return self._index.keys()
+
+    def getinfo(self, name):
+        return self._index[name]
+
+    def read(self, name):
+        return ''.join(self.iter_chunks(name))
+
+    def iter_chunks(self, name, chunk_size=CHUNK_SIZE):
+        """
+        Returns an iterator over the uncompressed contents of ``name``, in
+        chunks of at most ``chunk_size`` bytes. A :exc:`ThemeSizeError` is
+        raised straight away if the member is recorded as larger than the
+        maximum file size; :exc:`zipfile.BadZipfile` is raised while
+        iterating if its contents don't match what is recorded.
+
+        """
+        info = self._index[name]
+        max_file_size = get_max_file_size()
+        if max_file_size is not None and info.file_size > max_file_size:
+            raise ThemeSizeError("{0} is larger than {1} bytes.".format(
+                                                    name, max_file_size))
+        # Encrypted or unusually compressed members go through zipfile.
+        if info.flag_bits & 0x1 or info.compress_type not in (
+                                    zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            chunks = self._read_locked(info, chunk_size)
+        else:
+            start = self._data_offset(info)
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                chunks = self._inflate(start, info.compress_size, chunk_size)
+            else:
+                chunks = self._slice(start, info.compress_size, chunk_size)
+        return self._check(info, chunks)
+
+    def close(self):
+        self._zip_file.close()
+        self._map.close()
+        self._fp.close()
+
+    def _check(self, info, chunks):
+        size, crc = 0, 0
+        for chunk in chunks:
+            size += len(chunk)
+            if size > info.file_size:
+                raise zipfile.BadZipfile("{0!r} uncompresses to more than "
+                                         "{1} bytes".format(info.filename,
+                                                            info.file_size))
+            crc = zlib.crc32(chunk, crc)
+            yield chunk
+        if size != info.file_size or crc & 0xffffffff != info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file "
+                                     "{0!r}".format(info.filename))
+
+    def _slice(self, start, size, chunk_size):
+        for offset in xrange(start, start + size, chunk_size):
+            yield self._map[offset:min(offset + chunk_size, start + size)]
+
+    def _inflate(self, start, size, chunk_size):
+        # max_length keeps each piece of output to chunk_size bytes, however
+        # well the input compresses; the rest waits in unconsumed_tail.
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        for data in self._slice(start, size, chunk_size):
+            while data:
+                chunk = decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+                if chunk:
+                    yield chunk
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+    def _read_locked(self, info, chunk_size):
+        # zipfile's file objects share the underlying file, so the member is
+        # read in one go while holding the lock, though still in chunks so
+        # that its size can be checked as it's read.
+        chunks, size = [], 0
+        with self._lock:
+            fp = self._zip_file.open(info)
+            try:
+                while size <= info.file_size:
+                    chunk = fp.read(chunk_size)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    chunks.append(chunk)
+            finally:
+                fp.close()
+        return chunks
+
+    def _data_offset(self, info):
+        offset = self._offsets.get(info.filename)
+        if offset is None:
+            start = info.header_offset
+            header = struct.unpack(
+                _LOCAL_HEADER_FORMAT,
+                self._map[start:start + _LOCAL_HEADER_SIZE])
+            if header[0] != _LOCAL_HEADER_SIGNATURE:
+                raise zipfile.BadZipfile("Bad local file header for "
+                                         "{0!r}".format(info.filename))
+            offset = (start + _LOCAL_HEADER_SIZE + header[_NAME_LENGTH] +
+                      header[_EXTRA_LENGTH])
+            self._offsets[info.filename] = offset
+        return offset
+
+
+def open_zip_reader(field_file):
+    """
+    Returns a :class:`ZipReader` for a :class:`FieldFile`. If the file's
+    storage has no local path for it, it is first copied to a temporary
+    file, which is removed when the reader is closed or garbage-collected.
+
+    """
+    try:
+        path = field_file.path
+    except NotImplementedError:
+        path = None
+
+    if path is not None and os.path.exists(path):
+        return ZipReader(open(path, 'rb'))
+
+    fp = tempfile.TemporaryFile()
+    field_file.open('rb')
+    try:
+        shutil.copyfileobj(field_file, fp)
+    finally:
+        field_file.close()
+    fp.flush()
+    fp.seek(0)
+    return ZipReader(fp)